@@ -0,0 +1,104 @@
+# Cost per path of matching config['exclude_options'] in
+# external_package_sync.py, fnmatch'ing every pattern as robocopy would
+# versus the compiled ExcludeMatcher, on a synthetic package tree.
+#
+#   python bench/bench_exclude_matcher.py [--entries 100000] [--repeat 3]
+import argparse
+import fnmatch
+import os
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+import external_package_sync
+
+
+# Names of a Packages tree: plugins, their byte code, settings, VCS and
+# node_modules directories
+dir_names = ['commands', 'lib', 'syntax', '.git', 'node_modules', '__pycache__', 'tests']
+file_names = ['plugin%d.py', 'plugin%d.pyc', 'Default%d.sublime-keymap',
+              'Main%d.sublime-menu', 'cache%d.json', 'README%d.md']
+
+
+# Returns [(path, is_dir)] of about entries paths, a directory before its
+# contents
+def synthetic_tree(entries, root):
+    tree = []
+    stack = [(root, 0)]
+    while stack and len(tree) < entries:
+        path, depth = stack.pop(0)
+        for i in range(12):
+            name = file_names[i % len(file_names)] % i
+            tree.append((os.path.join(path, name), False))
+        if depth < 4:
+            for name in dir_names:
+                child = os.path.join(path, name)
+                tree.append((child, True))
+                stack.append((child, depth + 1))
+        if path == root:
+            for i in range(200):
+                child = os.path.join(path, 'Package%d' % i)
+                tree.append((child, True))
+                stack.append((child, 1))
+    return tree[:entries]
+
+
+def naive_matcher():
+    dirs, files = external_package_sync.exclude_patterns()
+
+    def match(path, patterns):
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+    return lambda path: match(path, dirs), lambda path: match(path, files)
+
+
+def compiled_matcher():
+    matcher = external_package_sync.ExcludeMatcher()
+    return matcher.exclude_dir, matcher.exclude_file
+
+
+def run(tree, matchers, prune):
+    exclude_dir, exclude_file = matchers
+    # Directories not descended into, a directory comes before its contents
+    pruned = set()
+    matched = 0
+    checked = 0
+    start = time.time()
+    for path, is_dir in tree:
+        if prune and os.path.dirname(path) in pruned:
+            if is_dir:
+                pruned.add(path)
+            continue
+        checked += 1
+        if is_dir:
+            if exclude_dir(path):
+                matched += 1
+                if prune:
+                    pruned.add(path)
+        elif exclude_file(path):
+            matched += 1
+    return time.time() - start, checked, matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the exclude matcher of external_package_sync.py")
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tree = synthetic_tree(args.entries, os.path.join(os.sep, 'Packages'))
+    print("%d entries, %d directories" % (len(tree), sum(1 for p, d in tree if d)))
+    for name, make, prune in [("fnmatch", naive_matcher, False),
+                              ("compiled", compiled_matcher, False),
+                              ("compiled+prune", compiled_matcher, True)]:
+        matchers = make()
+        results = [run(tree, matchers, prune) for i in range(args.repeat)]
+        wall, checked, matched = min(results)
+        print("%-15s %8.3fs %8.2f us/path %8d checked %8d excluded" % (
+            name, wall, wall / len(tree) * 1e6, checked, matched))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# Throughput benchmark of the AsyncProcess -> ExecCommand pipeline of
+# exec2.py, run outside of Sublime Text with the stub modules next to this
+# file.
+#
+#   python bench/bench_exec2.py [--scale 1] [--repeat 3] [scenario ...]
+#   python bench/bench_exec2.py --save baseline.json
+#   python bench/bench_exec2.py --baseline baseline.json
+#
+# Each scenario runs in its own interpreter, so the peak RSS reported is the
+# one of that scenario alone.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Producers, run with "python -c". N is scaled by --scale.
+scenarios = {
+    # A compiler printing one warning per write
+    "small_lines": """
+import os
+for i in range(int(200000 * N)):
+    os.write(1, b"src/module%d.c:12:5: warning: unused variable 'x'\\n" % (i % 1000))
+""",
+    # A minified bundle or a log line without newlines
+    "huge_line": """
+import os
+chunk = b"x" * 2**20
+for i in range(int(32 * N)):
+    os.write(1, chunk)
+os.write(1, b"\\n")
+""",
+    # A test runner reporting progress on stdout and failures on stderr
+    "interleaved": """
+import os
+for i in range(int(100000 * N)):
+    os.write(1, b"test_%d ... ok\\n" % i)
+    os.write(2, b"tests/test_%d.py:1: DeprecationWarning\\n" % i)
+""",
+    # pip/cargo style progress bar redrawn with \\r
+    "progress": """
+import os
+for i in range(int(100000 * N)):
+    pct = i * 100 // int(100000 * N)
+    os.write(1, ("\\r[" + "#" * (pct // 2) + " " * (50 - pct // 2) + "] %3d%%" % pct).encode())
+os.write(1, b"\\n")
+""",
+    # UTF-8 text written in reads that split its multibyte sequences
+    "multibyte": """
+import os
+data = ("ビルドに失敗しました: ファイルが見つかりません\\n" * 2000).encode("utf-8")
+for i in range(int(20 * N)):
+    for j in range(0, len(data), 4093):
+        os.write(1, data[j:j + 4093])
+""",
+}
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB, except on darwin where getrusage reports bytes
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+# Runs one scenario in this interpreter, returning its measurements
+def run_scenario(name, scale):
+    sys.path.insert(0, bench_dir)
+    sys.path.insert(1, os.path.dirname(bench_dir))
+    import sublime
+    import exec2
+
+    settings = sublime.load_settings("Preferences.sublime-settings")
+    settings.set("exec_metrics_log", False)
+    settings.set("show_panel_on_build", False)
+
+    code = "N = %r\n" % scale + scenarios[name]
+    window = sublime.Window()
+    command = exec2.ExecCommand(window)
+    start = time.time()
+    command.run(cmd=[sys.executable, "-c", code], quiet=True)
+    sublime.run_loop(lambda: not exec2.get_scheduler(window).active_jobs(), timeout=600)
+    wall = time.time() - start
+
+    job = exec2.get_job(window)
+    total = sum(job.metrics.bytes.values())
+    return {
+        "scenario": name,
+        "bytes": total,
+        "wall": wall,
+        "mb_per_s": total / wall / 1e6,
+        "reads": sum(job.metrics.chunks.values()),
+        "dispatches": job.output_buffer.flush_count,
+        "appends": job.output_view.appends,
+        "set_timeout_calls": sublime.timeout_calls,
+        "max_dispatch_lag_ms": job.metrics.max_dispatch_lag * 1000,
+        "peak_rss_kb": peak_rss_kb(),
+        "exit_code": job.proc.exit_code(),
+    }
+
+
+def run_isolated(name, scale):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+        "--child", name, "--scale", str(scale)])
+    return json.loads(out.decode("utf-8").splitlines()[-1])
+
+
+def format_row(result, baseline=None):
+    row = "%-12s %8.1f MB %8.3fs %8.1f MB/s %8d reads %6d dispatches %6d appends %8.1fms lag %8s KiB" % (
+        result["scenario"], result["bytes"] / 1e6, result["wall"], result["mb_per_s"],
+        result["reads"], result["dispatches"], result["appends"],
+        result["max_dispatch_lag_ms"], result["peak_rss_kb"])
+    if baseline:
+        row += "  (%+.0f%% MB/s, %+d dispatches)" % (
+            (result["mb_per_s"] / baseline["mb_per_s"] - 1) * 100,
+            result["dispatches"] - baseline["dispatches"])
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the exec2.py output pipeline")
+    parser.add_argument("scenarios", nargs="*", default=sorted(scenarios))
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.scale)))
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = dict((r["scenario"], r) for r in json.load(f))
+
+    results = []
+    for name in args.scenarios:
+        # Report the wall time of the quickest run, but the peak RSS of all
+        runs = [run_isolated(name, args.scale) for i in range(args.repeat)]
+        best = min(runs, key=lambda r: r["wall"])
+        if best["exit_code"]:
+            print("%s: producer exited with %d" % (name, best["exit_code"]))
+        best["peak_rss_kb"] = max(r["peak_rss_kb"] or 0 for r in runs)
+        results.append(best)
+        print(format_row(best, baseline.get(name)))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Startup cost of external_package_sync.py in the plugin host: importing the
+# module, plugin_loaded() and the deferred init() it schedules, run outside
+# of Sublime Text with the stub modules next to this file.
+#
+#   python bench/bench_startup.py [--repeat 5]
+#
+# Each run is a fresh interpreter, so the import is a cold one.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure():
+    sys.path.insert(0, bench_dir)
+    sys.path.insert(1, os.path.dirname(bench_dir))
+    import sublime
+    import sublime_plugin
+    modules = len(sys.modules)
+
+    start = time.time()
+    import external_package_sync
+    imported = time.time()
+    external_package_sync.plugin_loaded()
+    loaded = time.time()
+    sublime.run_loop(lambda: external_package_sync.repo_base is not None, timeout=10)
+    initialized = time.time()
+
+    return {
+        "import_ms": (imported - start) * 1000,
+        "plugin_loaded_ms": (loaded - imported) * 1000,
+        "init_ms": (initialized - loaded) * 1000,
+        "modules": len(sys.modules) - modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of external_package_sync.py")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure()))
+        return
+
+    runs = []
+    for i in range(args.repeat):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"])
+        runs.append(json.loads(out.decode("utf-8").splitlines()[-1]))
+    # A cold import varies with the disk cache, compare the quickest child
+    best = min(runs, key=lambda r: r["import_ms"] + r["plugin_loaded_ms"])
+    print("import %.1fms, plugin_loaded %.2fms, deferred init %.1fms, %d modules imported" % (
+        best["import_ms"], best["plugin_loaded_ms"], best["init_ms"], best["modules"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# Minimal stand-in for the sublime module, enough to run exec2.py outside of
+# Sublime Text. Callbacks passed to set_timeout are queued, and run by
+# run_loop() on the calling thread, which plays the role of the UI thread.
+import heapq
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+ENCODED_POSITION = 1
+LITERAL = 1
+
+_timeouts = []
+_timeouts_lock = threading.Lock()
+_counter = itertools.count()
+timeout_calls = 0
+
+
+def set_timeout(callback, delay=0):
+    global timeout_calls
+    with _timeouts_lock:
+        timeout_calls += 1
+        heapq.heappush(_timeouts, (time.time() + delay / 1000.0, next(_counter), callback))
+
+
+set_timeout_async = set_timeout
+
+
+def run_loop(until, timeout=60):
+    end = time.time() + timeout
+    while time.time() < end:
+        callback = None
+        with _timeouts_lock:
+            if _timeouts and _timeouts[0][0] <= time.time():
+                callback = heapq.heappop(_timeouts)[2]
+        if callback:
+            callback()
+        elif until():
+            return True
+        else:
+            time.sleep(0.0005)
+    return False
+
+
+def version():
+    return "3211"
+
+
+def platform():
+    return {"nt": "windows", "posix": "linux"}.get(os.name, "osx")
+
+
+def cache_path():
+    return os.path.join(tempfile.gettempdir(), "sublime-bench-cache")
+
+
+def packages_path():
+    return os.path.join(tempfile.gettempdir(), "sublime-bench-packages")
+
+
+def status_message(message):
+    pass
+
+
+def error_message(message):
+    print(message)
+
+
+def ok_cancel_dialog(message, ok_title=""):
+    return True
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def __eq__(self, other):
+        return (self.a, self.b) == (other.a, other.b)
+
+
+class Settings(dict):
+    def set(self, key, value):
+        self[key] = value
+
+    def erase(self, key):
+        self.pop(key, None)
+
+
+_settings = {}
+
+
+def load_settings(name):
+    return _settings.setdefault(name, Settings())
+
+
+def save_settings(name):
+    pass
+
+
+class View(object):
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.view_id = next(View._ids)
+        self._settings = Settings()
+        self.clear()
+
+    def clear(self):
+        # Appends are collected in chunks, so the stub doesn't add a quadratic
+        # string concatenation of its own to the measurements
+        self.chunks = []
+        self.length = 0
+        self.appends = 0
+
+    def id(self):
+        return self.view_id
+
+    def settings(self):
+        return self._settings
+
+    def text(self):
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    def size(self):
+        return self.length
+
+    def substr(self, region):
+        return self.text()[region.begin():region.end()]
+
+    def text_point(self, row, col):
+        text = self.text()
+        point = 0
+        for i in range(row):
+            point = text.find("\n", point) + 1
+            if point == 0:
+                return len(text)
+        return point + col
+
+    def full_line(self, point):
+        text = self.text()
+        begin = text.rfind("\n", 0, point) + 1
+        end = text.find("\n", point)
+        return Region(begin, len(text) if end < 0 else end + 1)
+
+    def replace(self, edit, region, text):
+        old = self.text()
+        self.chunks = [old[:region.begin()] + text + old[region.end():]]
+        self.length = len(self.chunks[0])
+
+    def run_command(self, name, args=None):
+        args = args or {}
+        if name == "append":
+            self.chunks.append(args["characters"])
+            self.length += len(args["characters"])
+            self.appends += 1
+            return
+        import sublime_plugin
+        sublime_plugin.text_command(name)(self).run(None, **args)
+
+    def find_all_results(self):
+        return []
+
+    def assign_syntax(self, syntax):
+        pass
+
+    def file_name(self):
+        return None
+
+
+# Open windows, close() removes one
+_windows = []
+
+
+def windows():
+    return list(_windows)
+
+
+class Window(object):
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.window_id = next(Window._ids)
+        self.panels = {}
+        _windows.append(self)
+
+    def close(self):
+        if self in _windows:
+            _windows.remove(self)
+
+    def id(self):
+        return self.window_id
+
+    def create_output_panel(self, name):
+        view = self.panels.setdefault(name, View())
+        view.clear()
+        return view
+
+    def find_output_panel(self, name):
+        return self.panels.get(name)
+
+    def active_view(self):
+        return None
+
+    def run_command(self, name, args=None):
+        pass
+
+    def open_file(self, path, flags=0):
+        return View()
+
+    def show_quick_panel(self, items, on_done, *args, **kwargs):
+        pass
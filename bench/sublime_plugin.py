@@ -0,0 +1,37 @@
+# Minimal stand-in for the sublime_plugin module, see sublime.py
+import re
+
+_text_commands = {}
+
+
+def command_name(cls):
+    name = cls.__name__
+    if name.endswith("Command"):
+        name = name[:-len("Command")]
+    return re.sub(r"(?<!^)([A-Z])", r"_\1", name).lower()
+
+
+def text_command(name):
+    return _text_commands[name]
+
+
+class ApplicationCommand(object):
+    pass
+
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(object):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _text_commands[command_name(cls)] = cls
+
+    def __init__(self, view):
+        self.view = view
+
+
+class EventListener(object):
+    pass
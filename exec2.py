@@ -22,14 +22,556 @@ import threading
 import subprocess
 import functools
 import time
+import codecs
+import traceback
+import shutil
+import tempfile
+import io
+import re
+import hashlib
+import json
+import fnmatch
+import signal
+import binascii
+import collections
+import select
+
+try:
+    import selectors
+except ImportError:
+    # Python 3.3 (Sublime Text 3) and 2.x, fall back to a thread per stream
+    selectors = None
+
+# Default flush interval (ms) and byte threshold of OutputBuffer
+FLUSH_INTERVAL = 16
+FLUSH_THRESHOLD = 2**20
+
+# Bounds of the adaptive read size of ProcessReader
+MIN_CHUNK = 2**12
+MAX_CHUNK = 2**20
+
+# Default number of lines kept in the output panel, 0 for no limit
+SCROLLBACK_LINES = 50000
+
+# Default size limit of the build result cache in bytes
+CACHE_SIZE = 2**26
+
+# Size at which the metrics log is rotated
+METRICS_LOG_SIZE = 2**20
+
+# Seconds a killed build gets to exit on SIGTERM before it gets SIGKILL
+KILL_TIMEOUT = 3
+
+# Bytes a LogWriter may have queued before the readers wait for it
+LOG_PENDING = 2**22
 
 class ProcessListener(object):
     def on_data(self, proc, data):
         pass
 
+    # Called with the name of the stream ("stdout" or "stderr") the data was
+    # read from, listeners that keep per stream state can override this
+    def on_stream_data(self, proc, stream, data):
+        self.on_data(proc, data)
+
     def on_finished(self, proc):
         pass
 
+# Reads the pipes of every running AsyncProcess on one shared thread, instead
+# of two blocking threads per process. The thread exits when no pipe is left
+# open, and is started again by the next add()
+class ProcessReader(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.thread = None
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        # Every read goes into this buffer, only the bytes actually read are
+        # copied out of it
+        self.buffer = bytearray(MAX_CHUNK)
+
+    def add(self, proc, stream, f):
+        # The last item is the read size of the stream
+        self.register(f.fileno(), [proc, stream, f, MIN_CHUNK])
+
+    # Reads the stream again after proc.throttle() paused it
+    def resume(self, fd, data):
+        self.register(fd, data)
+
+    def register(self, fd, data):
+        with self.lock:
+            self.pending.append((fd, data))
+            running = self.thread is not None
+            if not running:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        if running:
+            os.write(self.wakeup_w, b"\0")
+
+    def run(self):
+        view = memoryview(self.buffer)
+        while True:
+            with self.lock:
+                for fd, data in self.pending:
+                    self.selector.register(fd, selectors.EVENT_READ, data)
+                self.pending = []
+                if len(self.selector.get_map()) == 1:
+                    self.thread = None
+                    return
+
+            for key, events in self.selector.select():
+                if key.fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 512)
+                else:
+                    self.read(key, view)
+
+    def read(self, key, view):
+        proc, stream, f, size = key.data
+        try:
+            n = os.readv(key.fd, [view[:size]])
+        except OSError:
+            n = 0
+
+        try:
+            if n > 0:
+                # Grow the read size for streams that fill it, and shrink it
+                # again for streams that only trickle
+                if n == size and size < MAX_CHUNK:
+                    key.data[3] = size * 2
+                elif n < size // 4 and size > MIN_CHUNK:
+                    key.data[3] = size // 2
+                if proc.on_stream_data(stream, bytes(view[:n])) is False:
+                    # The process is done with the stream, without closing it
+                    self.selector.unregister(key.fd)
+                elif proc.throttle(functools.partial(self.resume, key.fd, key.data)):
+                    # Stop reading only this stream until the process can
+                    # take more, the other builds keep being read
+                    self.selector.unregister(key.fd)
+            else:
+                self.selector.unregister(key.fd)
+                proc.on_stream_closed(stream, f)
+        except Exception:
+            # Don't let one listener take down the reader of every build
+            traceback.print_exc()
+
+if selectors and os.name != "nt":
+    process_reader = ProcessReader()
+else:
+    # select() doesn't support pipes on Windows
+    process_reader = None
+
+if os.name == "nt":
+    env_var_re = re.compile(r"\$(\w+)|\$\{([^}]*)\}|%([^%]*)%")
+else:
+    env_var_re = re.compile(r"\$(\w+)|\$\{([^}]*)\}")
+
+# Same as os.path.expandvars, but looks the variables up in environ instead
+# of os.environ
+def expand_vars(value, environ):
+    if "$" not in value and "%" not in value:
+        return value
+
+    def replace(m):
+        name = m.group(m.lastindex)
+        if m.lastindex == 3 and not name:
+            # %% is an escaped %
+            return "%"
+        if os.name == "nt":
+            name = name.upper()
+        return environ.get(name, m.group(0))
+
+    return env_var_re.sub(replace, value)
+
+# Builds the environment of build processes from os.environ, the env of the
+# build system and its "path" option, without modifying os.environ, so it can
+# be used from any thread. Environments are cached by their inputs, and
+# executables by the PATH they were looked up on
+class EnvironmentResolver(object):
+    MAX_ENTRIES = 32
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.envs = {}
+        self.executables = {}
+
+    def resolve(self, env, path=""):
+        environ = dict(os.environ)
+        key = (frozenset(environ.items()), frozenset(env.items()), path)
+        with self.lock:
+            proc_env = self.envs.get(key)
+        if proc_env is not None:
+            return proc_env
+
+        if path:
+            # The user decides in the build system whether he wants to append $PATH
+            # or tuck it at the front: "$PATH;C:\\new\\path", "C:\\new\\path;$PATH"
+            environ["PATH"] = expand_vars(path, environ)
+
+        proc_env = environ.copy()
+        proc_env.update(env)
+        for k, v in proc_env.items():
+            proc_env[k] = expand_vars(v, environ)
+
+        with self.lock:
+            if len(self.envs) >= self.MAX_ENTRIES:
+                self.envs.clear()
+            self.envs[key] = proc_env
+        return proc_env
+
+    # Returns the full path of executable on the PATH of env, or executable
+    # itself if it isn't found there. On Windows a relative executable is
+    # looked up in cwd first: CreateProcess and shutil.which would look in
+    # the current directory of Sublime Text instead
+    def which(self, executable, env, cwd=None):
+        if not hasattr(shutil, "which"):
+            return executable
+        path = env.get("PATH")
+        if os.name == "nt" and cwd:
+            if os.path.dirname(executable):
+                executable = os.path.join(cwd, executable)
+            else:
+                path = cwd + os.pathsep + (path or "")
+        if os.path.dirname(executable):
+            if os.name == "nt":
+                # Adds the extension of build.bat called as "build"
+                return shutil.which(executable) or executable
+            return executable
+
+        key = (executable, path)
+        with self.lock:
+            if key in self.executables:
+                return self.executables[key]
+
+        found = shutil.which(executable, path=path) or executable
+        with self.lock:
+            if len(self.executables) >= self.MAX_ENTRIES:
+                self.executables.clear()
+            self.executables[key] = found
+        return found
+
+environment_resolver = EnvironmentResolver()
+
+# Arguments for Popen starting the process in a new session, so it and every
+# process it starts can be killed together
+def new_session_args():
+    if os.name != "posix":
+        return {}
+    if sys.version_info >= (3, 2, 0):
+        return {"start_new_session": True}
+    return {"preexec_fn": os.setsid}
+
+# Sends SIGTERM to the process group pgid, and SIGKILL after KILL_TIMEOUT
+# seconds to whatever is left of it
+def kill_process_group(pgid):
+    def signal_group(sig):
+        try:
+            os.killpg(pgid, sig)
+            return True
+        except OSError:
+            return False
+
+    if signal_group(signal.SIGTERM):
+        timer = threading.Timer(KILL_TIMEOUT, signal_group, [signal.SIGKILL])
+        timer.daemon = True
+        timer.start()
+
+# Counts the processes of each running build and their peak RSS by sampling
+# the sessions of /proc on one shared thread (Linux only). rusage has no
+# process count, and its ru_maxrss starts from the memory of Sublime Text,
+# which the forked child keeps through exec
+class ProcessSampler(object):
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procs = []
+        self.thread = None
+
+    def track(self, proc):
+        with self.lock:
+            self.procs.append(proc)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def untrack(self, proc):
+        with self.lock:
+            if proc in self.procs:
+                self.procs.remove(proc)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.procs:
+                    self.thread = None
+                    return
+                procs = list(self.procs)
+
+            sessions = self.sessions()
+            for proc in procs:
+                pids = sessions.get(proc.proc.pid, ())
+                proc.seen_pids.update(pids)
+                for pid in pids:
+                    proc.peak_rss = max(proc.peak_rss, self.peak_rss(pid))
+            time.sleep(self.INTERVAL)
+
+    # The VmHWM of pid in bytes, 0 once it has exited
+    def peak_rss(self, pid):
+        try:
+            with open("/proc/%d/status" % pid) as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError, ValueError):
+            pass
+        return 0
+
+    # The pids of each session
+    def sessions(self):
+        sessions = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open("/proc/" + name + "/stat") as f:
+                    stat = f.read()
+            except (IOError, OSError):
+                continue
+            # The command name may contain spaces, the fields after it don't:
+            # state ppid pgrp session ...
+            fields = stat[stat.rfind(")") + 2:].split()
+            sessions.setdefault(int(fields[3]), []).append(int(name))
+        return sessions
+
+if os.path.isdir("/proc/self"):
+    process_sampler = ProcessSampler()
+else:
+    process_sampler = None
+
+def shell_quote(s):
+    return "'" + s.replace("'", "'\\''") + "'"
+
+# A shell started ahead of the builds it runs. Each shell_cmd sent to it
+# runs in a subshell, followed by a marker line with the exit code on stdout
+# and a marker line on stderr, so the shell's startup (and reading the
+# profile of the login shell on OS X) is paid once per worker, not per build
+class ShellWorker(object):
+    def __init__(self, args, env):
+        self.key = worker_key(args, env)
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+            start_new_session=True)
+        self.uses = 0
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, shell_cmd, cwd, token):
+        self.uses += 1
+        script = ("(cd %s && eval %s) </dev/null; "
+            "printf '\\037%s %%d\\n' $?; printf '\\037%s\\n' >&2\n"
+            % (shell_quote(cwd or "."), shell_quote(shell_cmd), token, token))
+        self.proc.stdin.write(script.encode("utf-8"))
+        self.proc.stdin.flush()
+
+    def kill(self):
+        kill_process_group(self.proc.pid)
+
+def worker_key(args, env):
+    return (tuple(args), frozenset(env.items()))
+
+# Idle ShellWorkers by the shell and environment they were started with.
+# Workers are retired after max_uses builds, and replaced by a new idle
+# worker right away, so the next build finds a warm shell. release() is
+# called by the reader thread, so the replacement is started on a thread of
+# its own
+class ShellPool(object):
+    MAX_IDLE = 4
+
+    def __init__(self, max_uses=20):
+        self.max_uses = max_uses
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self, args, env):
+        key = worker_key(args, env)
+        with self.lock:
+            for i, worker in enumerate(self.idle):
+                if worker.key == key and worker.alive():
+                    del self.idle[i]
+                    return worker
+        return ShellWorker(args, env)
+
+    def release(self, worker):
+        if worker.uses >= self.max_uses:
+            worker.kill()
+            thread = threading.Thread(target=self.replace, args=(worker.key,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.add_idle(worker)
+
+    def replace(self, key):
+        try:
+            worker = ShellWorker(key[0], dict(key[1]))
+        except (OSError, ValueError) as e:
+            print("[exec] can't start a shell worker: " + str(e))
+            return
+        self.add_idle(worker)
+
+    def add_idle(self, worker):
+        with self.lock:
+            self.idle.append(worker)
+            while len(self.idle) > self.MAX_IDLE:
+                self.idle.pop(0).kill()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for worker in idle:
+            worker.kill()
+
+worker_pool = ShellPool()
+
+# Finds the marker a ShellWorker writes after the output of a build, which
+# may be split across reads
+class FrameScanner(object):
+    def __init__(self, token):
+        self.token = b"\x1f" + token.encode("ascii")
+        self.pending = b""
+
+    # Returns the output before the marker, and the rest of the marker line
+    # once it has been read completely
+    def feed(self, data):
+        data = self.pending + data
+        self.pending = b""
+        i = data.find(self.token)
+        if i >= 0:
+            end = data.find(b"\n", i)
+            if end < 0:
+                self.pending = data[i:]
+                return data[:i], None
+            return data[:i], data[i + len(self.token):end].strip()
+
+        # Hold back the end of data if it may be the start of the marker
+        i = data.rfind(b"\x1f", max(0, len(data) - len(self.token)))
+        if i >= 0 and self.token.startswith(data[i:]):
+            self.pending = data[i:]
+            return data[:i], None
+        return data, None
+
+# Writes the raw output of a build to a log file on a background thread,
+# optionally compressed. The chunks queued are the ones handed to the
+# listener, so teeing doesn't copy them. Once max_pending bytes are queued,
+# a blocking write() waits for the disk. The shared ProcessReader must not
+# block, it asks throttle() instead and stops reading the stream until the
+# writer catches up
+class LogWriter(object):
+    def __init__(self, path, compression=None, max_pending=LOG_PENDING):
+        if compression is None:
+            if path.endswith(".gz"):
+                compression = "gzip"
+            elif path.endswith(".zst"):
+                compression = "zstd"
+
+        if compression == "gzip":
+            import gzip
+            self.file = gzip.open(path, "wb")
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("log_compression zstd requires the zstandard module")
+            self.file = zstandard.ZstdCompressor().stream_writer(io.open(path, "wb"))
+        elif compression:
+            raise ValueError("unknown log_compression: " + str(compression))
+        else:
+            self.file = io.open(path, "wb")
+
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.pending = 0
+        # Called once pending drops under max_pending again
+        self.waiters = []
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data, block=True):
+        with self.cond:
+            while block and self.pending >= self.max_pending and not self.error:
+                self.cond.wait()
+            if self.error:
+                return
+            self.queue.append(data)
+            self.pending += len(data)
+            self.cond.notify_all()
+
+    # Returns True if max_pending bytes are queued, resume is then called
+    # from the writer thread once there is room again
+    def throttle(self, resume):
+        with self.cond:
+            if self.pending < self.max_pending or self.error:
+                return False
+            self.waiters.append(resume)
+            return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def wake_waiters(self):
+        with self.cond:
+            if self.pending >= self.max_pending and not self.error:
+                return
+            waiters = self.waiters
+            self.waiters = []
+        for resume in waiters:
+            resume()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                chunks = list(self.queue)
+                self.queue.clear()
+
+            try:
+                for data in chunks:
+                    self.file.write(data)
+            except (IOError, OSError) as e:
+                print("[exec] can't write log file: " + str(e))
+                with self.cond:
+                    # Stop teeing instead of blocking the build
+                    self.error = e
+                    self.queue.clear()
+                    self.pending = 0
+                    self.cond.notify_all()
+                self.wake_waiters()
+                break
+
+            with self.cond:
+                self.pending -= sum(len(data) for data in chunks)
+                self.cond.notify_all()
+            self.wake_waiters()
+
+        try:
+            self.file.close()
+        except (IOError, OSError):
+            pass
+
 # Encapsulates subprocess.Popen, forwarding stdout to a supplied
 # ProcessListener (on a separate thread)
 class AsyncProcess(object):
@@ -37,7 +579,14 @@ class AsyncProcess(object):
             # "path" is an option in build systems
             path="",
             # "shell" is an options in build systems
-            shell=False):
+            shell=False,
+            # Working directory of the process
+            working_dir="",
+            # Run shell_cmd in a warm shell from shell_pool
+            shell_pool=False,
+            # Tee the raw output to this file, compressed with "gzip" or
+            # "zstd" if log_compression is given or the file ends in .gz/.zst
+            log_file=None, log_compression=None):
 
         if not shell_cmd and not cmd:
             raise ValueError("shell_cmd or cmd is required")
@@ -47,6 +596,10 @@ class AsyncProcess(object):
 
         self.listener = listener
         self.killed = False
+        self.worker = None
+        self.rusage = None
+        self.seen_pids = set()
+        self.peak_rss = 0
 
         self.start_time = time.time()
 
@@ -56,49 +609,79 @@ class AsyncProcess(object):
             startupinfo = subprocess.STARTUPINFO()
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-        # Set temporary PATH to locate executable in cmd
-        if path:
-            old_path = os.environ["PATH"]
-            # The user decides in the build system whether he wants to append $PATH
-            # or tuck it at the front: "$PATH;C:\\new\\path", "C:\\new\\path;$PATH"
-            os.environ["PATH"] = os.path.expandvars(path)
-
-        proc_env = os.environ.copy()
-        proc_env.update(env)
-        for k, v in proc_env.items():
-            proc_env[k] = os.path.expandvars(v)
+        proc_env = environment_resolver.resolve(env, path)
 
         if sys.version_info < (3, 0, 0):
-            for k, v in proc_env.items():
-                proc_env[k] = v.encode(sys.getfilesystemencoding())
-
-        if shell_cmd and sys.platform == "win32":
-            # Use shell=True on Windows, so shell_cmd is passed through with the correct escaping
-            self.proc = subprocess.Popen(shell_cmd, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, shell=True)
-        elif shell_cmd and sys.platform == "darwin":
-            # Use a login shell on OSX, otherwise the users expected env vars won't be setup
-            self.proc = subprocess.Popen(["/bin/bash", "-l", "-c", shell_cmd], stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, shell=False)
-        elif shell_cmd and sys.platform == "linux":
-            # Explicitly use /bin/bash on Linux, to keep Linux and OSX as
-            # similar as possible. A login shell is explicitly not used for
-            # linux, as it's not required
-            self.proc = subprocess.Popen(["/bin/bash", "-c", shell_cmd], stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, shell=False)
-        else:
-            # Old style build system, just do what it asks
-            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, shell=shell)
+            proc_env = dict((k, v.encode(sys.getfilesystemencoding()))
+                for k, v in proc_env.items())
 
-        if path:
-            os.environ["PATH"] = old_path
+        # Locate the executable in cmd on the PATH of the process, rather
+        # than the one of Sublime Text
+        if cmd and not shell_cmd and not shell:
+            cmd = [environment_resolver.which(cmd[0], proc_env, working_dir)] + list(cmd[1:])
 
-        if self.proc.stdout:
-            threading.Thread(target=self.read_stdout).start()
+        cwd = working_dir or None
+        session = new_session_args()
 
+        self.log = None
+        if log_file:
+            log_file = os.path.join(working_dir, os.path.expanduser(expand_vars(log_file, proc_env)))
+            self.log = LogWriter(log_file, log_compression)
+
+        try:
+            if (shell_cmd and shell_pool and sys.platform in ("darwin", "linux")
+                    and sys.version_info >= (3, 0, 0)):
+                # Same shells as below, reading the commands from stdin
+                if sys.platform == "darwin":
+                    args = ["/bin/bash", "-l"]
+                else:
+                    args = ["/bin/bash"]
+                self.worker = worker_pool.acquire(args, proc_env)
+                self.proc = self.worker.proc
+                token = "exec-done-" + binascii.hexlify(os.urandom(8)).decode("ascii")
+                self.scanners = {"stdout": FrameScanner(token), "stderr": FrameScanner(token)}
+                self.worker_exit_code = None
+                self.worker.run(shell_cmd, cwd, token)
+            elif shell_cmd and sys.platform == "win32":
+                # Use shell=True on Windows, so shell_cmd is passed through with the correct escaping
+                self.proc = subprocess.Popen(shell_cmd, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, cwd=cwd, shell=True, **session)
+            elif shell_cmd and sys.platform == "darwin":
+                # Use a login shell on OSX, otherwise the users expected env vars won't be setup
+                self.proc = subprocess.Popen(["/bin/bash", "-l", "-c", shell_cmd], stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, cwd=cwd, shell=False, **session)
+            elif shell_cmd and sys.platform == "linux":
+                # Explicitly use /bin/bash on Linux, to keep Linux and OSX as
+                # similar as possible. A login shell is explicitly not used for
+                # linux, as it's not required
+                self.proc = subprocess.Popen(["/bin/bash", "-c", shell_cmd], stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, cwd=cwd, shell=False, **session)
+            else:
+                # Old style build system, just do what it asks
+                self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, cwd=cwd, shell=shell, **session)
+        except Exception:
+            # Don't leave the writer thread waiting and the log file open
+            if self.log:
+                self.log.close()
+            raise
+
+        if process_sampler and not self.worker:
+            process_sampler.track(self)
+
+        streams = []
+        if self.proc.stdout:
+            streams.append(("stdout", self.proc.stdout))
         if self.proc.stderr:
-            threading.Thread(target=self.read_stderr).start()
+            streams.append(("stderr", self.proc.stderr))
+
+        self.streams_lock = threading.Lock()
+        self.open_streams = len(streams)
+        for stream, f in streams:
+            if process_reader:
+                process_reader.add(self, stream, f)
+            else:
+                threading.Thread(target=self.read_stream, args=(stream, f)).start()
 
     def kill(self):
         if not self.killed:
@@ -108,189 +691,1660 @@ class AsyncProcess(object):
                 startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
                 subprocess.check_call(['python.exe', helper_script, str(self.proc.pid)], startupinfo=startupinfo)
                 self.proc.wait()
+            elif self.worker:
+                # The worker is discarded along with the build
+                self.worker.kill()
+            elif os.name == "posix":
+                # Take down everything the build started, not just the shell
+                kill_process_group(self.proc.pid)
             else:
                 self.proc.terminate()
             self.listener = None
 
     def poll(self):
+        if self.worker:
+            return self.worker_exit_code == None and self.worker.alive()
         return self.proc.poll() == None
 
     def exit_code(self):
+        if self.worker:
+            return self.worker_exit_code
         return self.proc.poll()
 
-    def read_stdout(self):
+    def read_stream(self, stream, f):
         while True:
-            data = os.read(self.proc.stdout.fileno(), 2**15)
+            data = os.read(f.fileno(), 2**15)
 
             if len(data) > 0:
-                if self.listener:
-                    self.listener.on_data(self, data)
+                if self.on_stream_data(stream, data) is False:
+                    return
             else:
-                self.proc.stdout.close()
-                if self.listener:
-                    self.listener.on_finished(self)
                 break
 
-    def read_stderr(self):
-        while True:
-            data = os.read(self.proc.stderr.fileno(), 2**15)
+        self.on_stream_closed(stream, f)
 
-            if len(data) > 0:
-                if self.listener:
-                    self.listener.on_data(self, data)
-            else:
-                self.proc.stderr.close()
-                break
+    # Returns False once the stream holds no more output of this process
+    def on_stream_data(self, stream, data):
+        trailer = None
+        if self.worker:
+            data, trailer = self.scanners[stream].feed(data)
 
-class ExecCommand(sublime_plugin.WindowCommand, ProcessListener):
-    def run(self, cmd = None, shell_cmd = None, file_regex = "", line_regex = "", working_dir = "",
-            encoding = "utf-8", env = {}, quiet = False, kill = False,
-            word_wrap = True, syntax = None,
-            # Catches "path" and "shell"
-            **kwargs):
+        if self.log and data:
+            # The shared reader pauses the stream through throttle() instead
+            self.log.write(data, block=not process_reader)
 
-        if kill:
-            if self.proc:
-                self.proc.kill()
-                self.proc = None
-                self.append_string(None, "[Cancelled]")
+        listener = self.listener
+        if listener and data:
+            listener.on_stream_data(self, stream, data)
+
+        if trailer is not None:
+            if stream == "stdout":
+                try:
+                    self.worker_exit_code = int(trailer)
+                except ValueError:
+                    self.worker_exit_code = -1
+            self.on_stream_closed(stream, None)
+            return False
+        return True
+
+    # Returns True if the reader should stop reading the stream it just read
+    # until resume is called, because the log writer is behind
+    def throttle(self, resume):
+        return bool(self.log) and self.log.throttle(resume)
+
+    def on_stream_closed(self, stream, f):
+        if f:
+            f.close()
+        with self.streams_lock:
+            self.open_streams -= 1
+            finished = self.open_streams == 0
+
+        if not finished:
             return
 
-        if not hasattr(self, 'output_view'):
-            # Try not to call get_output_panel until the regexes are assigned
-            if hasattr(self.window, 'create_output_panel'):
-                self.output_view = self.window.create_output_panel("exec")
+        if self.log:
+            self.log.close()
+
+        if self.worker:
+            try:
+                if not self.killed and self.worker.alive():
+                    worker_pool.release(self.worker)
+            finally:
+                # The build is over even if the worker couldn't be reused
+                self.notify_finished()
+        elif hasattr(os, "wait4"):
+            # Wait for the process on its own thread, it may outlive its
+            # output
+            threading.Thread(target=self.reap).start()
+        else:
+            self.notify_finished()
+
+    # Waits for the process, collecting its resource usage
+    def reap(self):
+        try:
+            pid, status, self.rusage = os.wait4(self.proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.proc.returncode = -os.WTERMSIG(status)
             else:
-                self.output_view = self.window.get_output_panel("exec")
+                self.proc.returncode = os.WEXITSTATUS(status)
+        except OSError:
+            # Already reaped by Popen.poll()
+            pass
 
-        # Default the to the current files directory if no working directory was given
-        if (working_dir == "" and self.window.active_view()
-                        and self.window.active_view().file_name()):
-            working_dir = os.path.dirname(self.window.active_view().file_name())
-
-        self.output_view.settings().set("result_file_regex", file_regex)
-        self.output_view.settings().set("result_line_regex", line_regex)
-        self.output_view.settings().set("result_base_dir", working_dir)
-        self.output_view.settings().set("word_wrap", word_wrap)
-        self.output_view.settings().set("line_numbers", False)
-        self.output_view.settings().set("gutter", False)
-        self.output_view.settings().set("scroll_past_end", False)
-        if syntax:
-            if hasattr(self.window, 'assign_syntax'):
-                self.output_view.assign_syntax(syntax)
+        if process_sampler:
+            process_sampler.untrack(self)
+        self.notify_finished()
+
+    # Only report the process as finished once all of its streams have been
+    # drained
+    def notify_finished(self):
+        listener = self.listener
+        if listener:
+            listener.on_finished(self)
+
+    # CPU times, peak RSS and process count of the finished process, or None.
+    # The peak RSS is None when the process exited before it was sampled
+    def resource_usage(self):
+        if not self.rusage:
+            return None
+        if process_sampler:
+            maxrss = self.peak_rss or None
+        elif sys.platform == "darwin":
+            maxrss = self.rusage.ru_maxrss
+        else:
+            maxrss = self.rusage.ru_maxrss * 1024
+        return {
+            "user": self.rusage.ru_utime,
+            "sys": self.rusage.ru_stime,
+            "maxrss": maxrss,
+            "processes": len(self.seen_pids) if process_sampler else None,
+        }
+
+# Decodes the output of one stream of a process incrementally, so multibyte
+# sequences and \r\n pairs split across reads are handled correctly, and
+# normalizes newlines, Sublime Text always uses a single \n separator in
+# memory
+class StreamDecoder(object):
+    # translate_cr=False keeps lone \r characters, for an OutputTransform to
+    # handle
+    def __init__(self, encoding, translate_cr=True):
+        self.encoding = encoding
+        self.translate_cr = translate_cr
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.pending_cr = False
+        self.failed = False
+
+    def decode(self, data, final=False):
+        try:
+            text = self.decoder.decode(data, final)
+        except UnicodeDecodeError:
+            # Report the error once, and decode the rest of the stream
+            # with replacement characters instead of dropping it
+            buffered = self.decoder.getstate()[0]
+            self.decoder = codecs.getincrementaldecoder(self.encoding)("replace")
+            text = self.decoder.decode(buffered + data, final)
+            if not self.failed:
+                self.failed = True
+                text = "[Decode error - output not " + self.encoding + "]\n" + text
+
+        # A \r at the end of the chunk may be the first half of a \r\n pair
+        if self.pending_cr:
+            text = "\r" + text
+        self.pending_cr = not final and text.endswith("\r")
+        if self.pending_cr:
+            text = text[:-1]
+
+        text = text.replace("\r\n", "\n")
+        if self.translate_cr:
+            text = text.replace("\r", "\n")
+        return text
+
+ansi_escape_re = re.compile(r"\x1b(\[[0-9;?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[@-Z\\-_])")
+# An escape sequence that may continue in the next chunk
+ansi_partial_re = re.compile(r"\x1b(\[[0-9;?]*[ -/]*|\][^\x07\x1b]*)?$")
+
+# Default options of OutputTransform, see the "filters" build option
+FILTERS = {
+    # Handle \r like a terminal does, only the final state of a line is shown
+    "carriage_return": True,
+    # Remove ANSI escape sequences (colors, cursor movement)
+    "strip_ansi": True,
+    # Show repeated lines once, followed by a count
+    "collapse_repeats": False,
+    # Regexes of lines to drop, and to keep (if given, only matching lines
+    # are shown)
+    "drop": [],
+    "keep": [],
+}
+
+# Rewrites the decoded output of a stream before it reaches the panel.
+# Complete lines go through all filters. An incomplete line is shown right
+# away when no filter needs to see it whole, otherwise it is held until its
+# newline arrives
+class OutputTransform(object):
+    def __init__(self, options):
+        self.carriage_return = options.get("carriage_return")
+        self.strip_ansi = options.get("strip_ansi")
+        self.collapse_repeats = options.get("collapse_repeats")
+        self.drop = [re.compile(r) for r in options.get("drop") or []]
+        self.keep = [re.compile(r) for r in options.get("keep") or []]
+        self.line_filters = bool(self.collapse_repeats or self.drop or self.keep)
+
+        # The incomplete line held back, the part of it already shown, and
+        # what the held text is drawn over: the shown part, or the current
+        # state of a line redrawn with \r
+        self.held = ""
+        self.shown = ""
+        self.base = ""
+        self.last_line = None
+        self.repeats = 0
+
+    def feed(self, text):
+        out = []
+        lines = text.split("\n")
+        for line in lines[:-1]:
+            self.line(self.held + line, out)
+            self.held = ""
+        self.held += lines[-1]
+
+        if self.carriage_return and "\r" in self.held:
+            # Keep only the current state of the line and the part after
+            # the last \r, which may still end in a partial escape sequence
+            i = self.held.rindex("\r")
+            self.base = overwrite(self.base + self.clean(self.held[:i]))
+            self.held = self.held[i:]
+
+        if self.held and not self.line_filters and "\r" not in self.held:
+            partial, self.held = self.held, ""
+            if self.strip_ansi:
+                # Hold back an escape sequence that may continue in the next
+                # chunk
+                m = ansi_partial_re.search(partial)
+                if m:
+                    partial, self.held = partial[:m.start()], partial[m.start():]
+                partial = ansi_escape_re.sub("", partial)
+            out.append(partial)
+            self.shown += partial
+            self.base += partial
+        return "".join(out)
+
+    def finish(self):
+        out = []
+        if self.held or self.shown:
+            count = len(out)
+            self.line(self.held, out)
+            self.held = ""
+            if len(out) > count:
+                # No newline ended the output, don't add one
+                out[-1] = out[-1][:-1]
+        self.flush_repeats(out)
+        return "".join(out)
+
+    # The current state of a line being redrawn with \r, for the status bar
+    def progress(self):
+        if "\r" in self.held:
+            return overwrite(self.base + self.clean(self.held)).strip()
+        return None
+
+    def clean(self, line):
+        if self.strip_ansi:
+            line = ansi_escape_re.sub("", line)
+        return line
+
+    def line(self, line, out):
+        line = self.clean(line)
+        if self.carriage_return:
+            line = overwrite(self.base + line)
+        else:
+            line = self.base + line
+        shown = self.shown
+        self.shown = ""
+        self.base = ""
+
+        if shown:
+            # Part of the line is in the panel already
+            if line.startswith(shown):
+                out.append(line[len(shown):] + "\n")
             else:
-                self.output_view.set_syntax_file(syntax)
+                out.append("\n" + line + "\n")
+            return
 
-        # Call create_output_panel a second time after assigning the above
-        # settings, so that it'll be picked up as a result buffer
-        if hasattr(self.window, 'create_output_panel'):
-            self.window.create_output_panel("exec")
+        if self.keep and not any(r.search(line) for r in self.keep):
+            return
+        if any(r.search(line) for r in self.drop):
+            return
+        if self.collapse_repeats:
+            if line == self.last_line:
+                self.repeats += 1
+                return
+            self.flush_repeats(out)
+            self.last_line = line
+        out.append(line + "\n")
+
+    def flush_repeats(self, out):
+        if self.repeats:
+            out.append("[previous line repeated %d more times]\n" % self.repeats)
+            self.repeats = 0
+
+# Applies the \r in line the way a terminal would: each part overwrites the
+# start of the line
+def overwrite(line):
+    if "\r" not in line:
+        return line
+    result = ""
+    for part in line.split("\r"):
+        result = part + result[len(part):]
+    return result
+
+# Collects the chunks read by the AsyncProcess threads, and hands them to
+# the UI thread as a single append per flush interval, instead of one
+# set_timeout per chunk
+class OutputBuffer(object):
+    def __init__(self, sink, interval=FLUSH_INTERVAL, threshold=FLUSH_THRESHOLD, metrics=None):
+        self.sink = sink
+        self.interval = interval
+        self.threshold = threshold
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.size = 0
+        self.scheduled = False
+        self.urgent = False
+        # When the oldest chunk waiting for the flush was written
+        self.oldest = None
+        # Flushes that had chunks to deliver
+        self.flush_count = 0
+
+    def write(self, proc, data, stream="stdout"):
+        with self.lock:
+            if not self.chunks:
+                self.oldest = time.time()
+            self.chunks.append((proc, stream, data))
+            self.size += len(data)
+            if self.size >= self.threshold:
+                # Don't let a fast producer grow the buffer until the
+                # next frame, flush as soon as the UI thread is free
+                if not self.urgent:
+                    self.urgent = True
+                    self.scheduled = True
+                    sublime.set_timeout(self.flush, 0)
+            elif not self.scheduled:
+                self.scheduled = True
+                sublime.set_timeout(self.flush, self.interval)
+
+    def flush(self):
+        with self.lock:
+            chunks = self.chunks
+            self.chunks = []
+            self.size = 0
+            self.scheduled = False
+            self.urgent = False
+            if chunks:
+                self.flush_count += 1
+                if self.metrics:
+                    self.metrics.on_dispatch(time.time() - self.oldest, len(chunks))
+
+        # Merge consecutive chunks of the same process and stream, the sink
+        # gets all the runs of the flush at once
+        runs = []
+        i = 0
+        while i < len(chunks):
+            proc, stream = chunks[i][:2]
+            j = i + 1
+            while j < len(chunks) and chunks[j][:2] == (proc, stream):
+                j += 1
+            runs.append((proc, stream, b"".join(c[2] for c in chunks[i:j])))
+            i = j
+        if runs:
+            self.sink(runs)
+
+# Keeps at most max_lines lines and max_size characters of output in the
+# panel. Once output has to be dropped, everything is written to a spill
+# file instead, which exec_open_spill opens
+class Scrollback(object):
+    def __init__(self, view, max_lines=0, max_size=0):
+        self.view = view
+        self.max_lines = max_lines
+        self.max_size = max_size
+        self.lines = 0
+        self.omitted = 0
+        self.spill = None
+        self.path = None
+
+    def append(self, text):
+        if self.spill:
+            self.spill.write(text)
+        self.lines += text.count("\n")
+
+        # Trim only once the limit is exceeded by a quarter, so the panel
+        # isn't edited at the front on every append
+        if ((self.max_lines and self.lines > self.max_lines * 5 // 4) or
+                (self.max_size and self.view.size() > self.max_size * 5 // 4)):
+            self.trim()
+
+    def trim(self):
+        view = self.view
+        end = 0
+        if self.max_lines and self.lines > self.max_lines:
+            end = view.text_point(self.lines - self.max_lines, 0)
+        if self.max_size and view.size() - end > self.max_size:
+            end = view.full_line(view.size() - self.max_size).end()
+        if end <= 0:
+            return
+
+        if self.spill is None:
+            fd, self.path = tempfile.mkstemp(prefix="exec-", suffix=".log")
+            self.spill = io.open(fd, "w", encoding="utf-8", newline="\n")
+            self.spill.write(view.substr(sublime.Region(0, view.size())))
+
+        # The marker line of a previous trim is removed along with the output
+        removed = view.substr(sublime.Region(0, end)).count("\n")
+        self.omitted += removed - (1 if self.omitted else 0)
+        self.lines += 1 - removed
+        marker = "[%d lines omitted, full output in %s]\n" % (self.omitted, self.path)
+        view.run_command("exec_trim_output", {"end": end, "marker": marker})
+
+    def flush(self):
+        if self.spill:
+            self.spill.flush()
+
+    def discard(self):
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+# Matches the result regexes of a build against its output as it streams
+# in, so results can be counted and navigated while the build is running
+class ResultIndex(object):
+    def __init__(self, file_regex, line_regex, base_dir):
+        self.file_re = re.compile(file_regex) if file_regex else None
+        self.line_re = re.compile(line_regex) if line_regex else None
+        self.base_dir = base_dir
+        self.results = []
+        self.partial = ""
+        self.last_file = None
+
+    def feed(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.match(line)
+
+    def finish(self):
+        if self.partial:
+            self.match(self.partial)
+            self.partial = ""
+
+    def match(self, line):
+        m = self.file_re.search(line) if self.file_re else None
+        if m:
+            file, row, col, message = (m.groups() + (None,) * 4)[:4]
+            if not file:
+                return
+            self.last_file = file
+            # A file without a line number only names the file of the
+            # results matched by line_regex
+            if row or not self.line_re:
+                self.add(file, row, col, message)
+            return
+
+        m = self.line_re.search(line) if self.line_re else None
+        if m and self.last_file:
+            row, col, message = (m.groups() + (None,) * 3)[:3]
+            self.add(self.last_file, row, col, message)
+
+    def add(self, file, row, col, message):
+        if not os.path.isabs(file):
+            file = os.path.join(self.base_dir, file)
+        self.results.append((file, to_int(row), to_int(col), message or ""))
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+# Stores the output of builds on disk, keyed by a digest of the command, its
+# environment and the input files under its working directory. Entries are
+# evicted least recently used first once the cache grows over max_size bytes
+class BuildCache(object):
+    def __init__(self, path, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def key(self, job, env, inputs):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([job.cmd, job.shell_cmd, job.working_dir,
+            job.encoding, job.kwargs.get("path", ""), sorted(env.items()),
+            inputs], sort_keys=True).encode("utf-8"))
+        for entry in self.fingerprint(job.working_dir, inputs):
+            digest.update(entry.encode("utf-8"))
+        return digest.hexdigest()
+
+    # Relative path, size and mtime of the files under working_dir that match
+    # one of the inputs globs, skipping hidden directories such as .git
+    def fingerprint(self, working_dir, inputs):
+        for root, dirs, files in os.walk(working_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, working_dir)
+                if any(fnmatch.fnmatch(rel, glob) for glob in inputs):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield "%s\0%d\0%r\n" % (rel, st.st_size, st.st_mtime)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with io.open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # The mtime of an entry is its last use
+            os.utime(path, None)
+            return entry
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, entry):
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            path = self.entry_path(key)
+            with io.open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False))
+            if hasattr(os, "replace"):
+                os.replace(path + ".tmp", path)
+            else:
+                # os.rename can't overwrite files on Windows
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(path + ".tmp", path)
+            self.evict()
+
+    def entries(self):
+        entries = []
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith(".json"):
+                    st = os.stat(os.path.join(self.path, name))
+                    entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, name in entries)
+        while entries and total > self.max_size:
+            mtime, size, name = entries.pop(0)
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            for mtime, size, name in self.entries():
+                os.remove(os.path.join(self.path, name))
+
+build_cache = None
+
+def get_build_cache():
+    global build_cache
+    if not build_cache:
+        if hasattr(sublime, "cache_path"):
+            path = os.path.join(sublime.cache_path(), "exec")
         else:
-            self.window.get_output_panel("exec")
+            path = os.path.join(tempfile.gettempdir(), "sublime-exec-cache")
+        settings = sublime.load_settings("Preferences.sublime-settings")
+        build_cache = BuildCache(path, settings.get("exec_cache_size", CACHE_SIZE))
+    return build_cache
 
+# Timings and counters of one build. The read counters are updated by the
+# reader thread, everything else on the UI thread
+class BuildMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = None
+        self.spawned = None
+        self.first_byte = None
+        self.last_byte = None
+        self.bytes = {"stdout": 0, "stderr": 0}
+        self.chunks = {"stdout": 0, "stderr": 0}
+        self.dispatches = 0
+        self.dispatch_lag = 0.0
+        self.max_dispatch_lag = 0.0
+        # Most chunks merged into one dispatch
+        self.max_merged = 0
+        self.appends = 0
+        self.append_time = 0.0
+
+    def on_read(self, stream, size):
+        now = time.time()
+        with self.lock:
+            if self.first_byte is None:
+                self.first_byte = now
+            self.last_byte = now
+            self.bytes[stream] = self.bytes.get(stream, 0) + size
+            self.chunks[stream] = self.chunks.get(stream, 0) + 1
+
+    def on_dispatch(self, lag, chunks):
+        self.dispatches += 1
+        self.dispatch_lag += lag
+        self.max_dispatch_lag = max(self.max_dispatch_lag, lag)
+        self.max_merged = max(self.max_merged, chunks)
+
+    def on_append(self, duration):
+        self.appends += 1
+        self.append_time += duration
+
+    def record(self, job, exit_code):
+        now = time.time()
+        with self.lock:
+            read_time = (self.last_byte - self.first_byte) if self.first_byte else 0.0
+            total = sum(self.bytes.values())
+            return {
+                "time": now,
+                "command": job.name(),
+                "working_dir": job.working_dir,
+                "exit_code": exit_code,
+                "wall": now - self.start,
+                "spawn": self.spawned - self.start,
+                "first_byte": (self.first_byte - self.start) if self.first_byte else None,
+                "bytes": dict(self.bytes),
+                "chunks": dict(self.chunks),
+                "throughput": total / read_time if read_time > 0 else None,
+                "dispatches": self.dispatches,
+                "dispatch_lag": self.dispatch_lag / self.dispatches if self.dispatches else 0.0,
+                "max_dispatch_lag": self.max_dispatch_lag,
+                "max_merged": self.max_merged,
+                "appends": self.appends,
+                "append_time": self.append_time,
+            }
+
+def metrics_log_path():
+    if hasattr(sublime, "cache_path"):
+        return os.path.join(sublime.cache_path(), "exec-metrics.jsonl")
+    return os.path.join(tempfile.gettempdir(), "sublime-exec-metrics.jsonl")
+
+# Appends record to the metrics log, keeping the previous log in .1 once it
+# gets over METRICS_LOG_SIZE
+def write_metrics(record):
+    path = metrics_log_path()
+    try:
+        if os.path.exists(path) and os.path.getsize(path) > METRICS_LOG_SIZE:
+            if os.path.exists(path + ".1"):
+                os.remove(path + ".1")
+            os.rename(path, path + ".1")
+        with io.open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except (IOError, OSError) as e:
+        print("[exec] can't write metrics: " + str(e))
+
+def read_metrics():
+    records = []
+    path = metrics_log_path()
+    for name in (path + ".1", path):
+        if os.path.exists(name):
+            with io.open(name, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+    return records
+
+# One build: its process, output panel and the state needed to append the
+# output of the process to the panel. Jobs are started by a BuildScheduler
+class BuildJob(ProcessListener):
+    def __init__(self, window, panel, cmd = None, shell_cmd = None, file_regex = "",
+            line_regex = "", working_dir = "", encoding = "utf-8", env = {}, quiet = False,
+            word_wrap = True, syntax = None, flush_interval = None, flush_threshold = None,
+            scrollback_lines = None, scrollback_size = None, cache = False, filters = None,
+            **kwargs):
+        self.window = window
+        self.panel = panel
+        self.cmd = cmd
+        self.shell_cmd = shell_cmd
+        self.file_regex = file_regex
+        self.line_regex = line_regex
+        self.working_dir = working_dir
         self.encoding = encoding
+        self.env = env
         self.quiet = quiet
+        self.word_wrap = word_wrap
+        self.syntax = syntax
+        self.kwargs = kwargs
 
         self.proc = None
-        if not self.quiet:
-            if shell_cmd:
-                print("Running " + shell_cmd)
+        self.scheduler = None
+        self.output_view = None
+        self.scrollback = None
+        self.result_index = None
+        self.decoders = {}
+        self.placeholder = None
+        self.state = "queued"
+        # When the job finished or was cancelled
+        self.ended = None
+
+        # "cache" is a dict with the "inputs" globs to fingerprint. Without
+        # them every file under working_dir would have to be walked
+        if cache and not (isinstance(cache, dict) and cache.get("inputs")):
+            print('[exec] "cache" needs "inputs" globs, not caching ' + self.name())
+            cache = False
+        self.cache = cache
+        self.cache_key = None
+        self.cache_output = None
+        self.metrics = BuildMetrics()
+
+        settings = sublime.load_settings("Preferences.sublime-settings")
+        self.kwargs.setdefault("shell_pool", settings.get("exec_shell_pool", False))
+        worker_pool.max_uses = settings.get("exec_shell_pool_uses", worker_pool.max_uses)
+        if flush_interval is None:
+            flush_interval = settings.get("exec_flush_interval", FLUSH_INTERVAL)
+        if flush_threshold is None:
+            flush_threshold = settings.get("exec_flush_threshold", FLUSH_THRESHOLD)
+        self.output_buffer = OutputBuffer(self.append_data,
+            flush_interval, flush_threshold, self.metrics)
+        self.log_metrics = settings.get("exec_metrics_log", True)
+
+        self.filters = dict(FILTERS)
+        self.filters.update(settings.get("exec_filters", {}))
+        self.filters.update(filters or {})
+        if not any(self.filters.values()):
+            self.filters = None
+
+        if scrollback_lines is None:
+            scrollback_lines = settings.get("exec_scrollback_lines", SCROLLBACK_LINES)
+        if scrollback_size is None:
+            scrollback_size = settings.get("exec_scrollback_size", 0)
+        self.scrollback_lines = scrollback_lines
+        self.scrollback_size = scrollback_size
+
+    def name(self):
+        if self.shell_cmd:
+            return self.shell_cmd
+        return " ".join(self.cmd)
+
+    def create_output_panel(self):
+        if hasattr(self.window, 'create_output_panel'):
+            return self.window.create_output_panel(self.panel)
+        else:
+            return self.window.get_output_panel(self.panel)
+
+    def show_placeholder(self, text):
+        self.output_view = self.create_output_panel()
+        self.output_view.run_command('append', {'characters': text, 'force': True, 'scroll_to_end': True})
+
+    def setup_output_panel(self):
+        if not self.output_view:
+            # Try not to call get_output_panel until the regexes are assigned
+            self.output_view = self.create_output_panel()
+
+        settings = self.output_view.settings()
+        settings.set("result_file_regex", self.file_regex)
+        settings.set("result_line_regex", self.line_regex)
+        settings.set("result_base_dir", self.working_dir)
+        settings.set("word_wrap", self.word_wrap)
+        settings.set("line_numbers", False)
+        settings.set("gutter", False)
+        settings.set("scroll_past_end", False)
+        if self.syntax:
+            if hasattr(self.window, 'assign_syntax'):
+                self.output_view.assign_syntax(self.syntax)
             else:
-                print("Running " + " ".join(cmd))
-            sublime.status_message("Building")
+                self.output_view.set_syntax_file(self.syntax)
 
-        show_panel_on_build = sublime.load_settings("Preferences.sublime-settings").get("show_panel_on_build", True)
-        if show_panel_on_build:
-            self.window.run_command("show_panel", {"panel": "output.exec"})
+        # Call create_output_panel a second time after assigning the above
+        # settings, so that it'll be picked up as a result buffer
+        self.create_output_panel()
+
+        self.scrollback = Scrollback(self.output_view,
+            self.scrollback_lines, self.scrollback_size)
+
+        try:
+            self.result_index = ResultIndex(self.file_regex, self.line_regex, self.working_dir)
+        except re.error as e:
+            # Sublime Text's regex engine accepts patterns Python's doesn't,
+            # fall back to find_all_results() when the build finishes
+            print("[exec] result regex not supported: " + str(e))
+            self.result_index = None
 
-        merged_env = env.copy()
+    def start(self):
+        self.state = "starting"
+        self.setup_output_panel()
+
+        if not self.quiet:
+            print("Running " + self.name())
+            sublime.status_message("Building")
+
+        merged_env = self.env.copy()
         if self.window.active_view():
             user_env = self.window.active_view().settings().get('build_env')
             if user_env:
                 merged_env.update(user_env)
 
-        # Change to the working dir, rather than spawning the process with it,
-        # so that emitted working dir relative path names make sense
-        if working_dir != "":
-            os.chdir(working_dir)
-
         self.debug_text = ""
-        if shell_cmd:
-            self.debug_text += "[shell_cmd: " + shell_cmd + "]\n"
+        if self.shell_cmd:
+            self.debug_text += "[shell_cmd: " + self.shell_cmd + "]\n"
         else:
-            self.debug_text += "[cmd: " + str(cmd) + "]\n"
-        self.debug_text += "[dir: " + str(os.getcwd()) + "]\n"
+            self.debug_text += "[cmd: " + str(self.cmd) + "]\n"
+        self.debug_text += "[dir: " + (self.working_dir or os.getcwd()) + "]\n"
         if "PATH" in merged_env:
             self.debug_text += "[path: " + str(merged_env["PATH"]) + "]"
         else:
             self.debug_text += "[path: " + str(os.environ["PATH"]) + "]"
 
+        # Spawning can take a while (a large environment, a virus scanner,
+        # a network drive), and so can fingerprinting the cache inputs, so
+        # both are done by a launcher thread
+        self.placeholder = "[Starting...]"
+        self.output_view.run_command('append', {'characters': self.placeholder, 'force': True, 'scroll_to_end': True})
+        # The cache loads its settings, so it's created on the UI thread
+        cache = get_build_cache() if self.cache else None
+        thread = threading.Thread(target=self.launch, args=(merged_env, cache))
+        thread.daemon = True
+        thread.start()
+
+    # Runs on the launcher thread
+    def launch(self, env, cache=None):
+        if cache is not None and self.lookup_cached(cache, env):
+            return
         try:
+            self.metrics.start = time.time()
             # Forward kwargs to AsyncProcess
-            self.proc = AsyncProcess(cmd, shell_cmd, merged_env, self, **kwargs)
+            proc = AsyncProcess(self.cmd, self.shell_cmd, env, self,
+                working_dir=self.working_dir, **self.kwargs)
+            self.metrics.spawned = time.time()
         except Exception as e:
-            print('[AsyncProcess]' + str(e))
-            self.append_string(None, str(e) + "\n")
-            self.append_string(None, self.debug_text + "\n")
-            if not self.quiet:
-                self.append_string(None, "[Finished]")
-
-    def is_enabled(self, kill = False):
-        if kill:
-            return hasattr(self, 'proc') and self.proc and self.proc.poll()
+            sublime.set_timeout(functools.partial(self.launch_failed, e), 0)
         else:
-            return True
+            sublime.set_timeout(functools.partial(self.launched, proc), 0)
+
+    # Makes proc the process of the job. Its output can be flushed before
+    # this is called from the launcher, so append_data and finish call it too
+    def launched(self, proc):
+        if self.state == "cancelled":
+            proc.kill()
+            return
+        if self.state != "starting":
+            return
+
+        self.state = "running"
+        self.proc = proc
+        self.clear_placeholder()
+
+    def launch_failed(self, e):
+        if self.state != "starting":
+            return
+
+        print('[AsyncProcess]' + str(e))
+        self.end("finished")
+        self.clear_placeholder()
+        self.append_string(None, str(e) + "\n")
+        self.append_string(None, self.debug_text + "\n")
+        if not self.quiet:
+            self.append_string(None, "[Finished]")
+        self.scheduler.job_finished(self)
 
-    def append_data(self, proc, data):
+    def clear_placeholder(self):
+        if self.placeholder:
+            self.output_view.run_command('exec_trim_output', {'end': len(self.placeholder)})
+            self.placeholder = None
+
+    # Runs on the launcher thread. Hands the cached result of the build to
+    # the UI thread if there is one, otherwise prepares for recording it
+    def lookup_cached(self, cache, env):
+        env = environment_resolver.resolve(env, self.kwargs.get("path", ""))
+        self.cache_key = cache.key(self, env, self.cache["inputs"])
+        entry = cache.get(self.cache_key)
+        if not entry:
+            self.cache_output = []
+            return False
+
+        sublime.set_timeout(functools.partial(self.replay_cached, entry), 0)
+        return True
+
+    def replay_cached(self, entry):
+        if self.state != "starting":
+            return
+
+        self.clear_placeholder()
+        self.append_text(entry["output"])
+        if self.result_index:
+            self.result_index.results = [tuple(r) for r in entry["results"]]
+        if not self.quiet:
+            self.append_text(self.finished_message(0.0, entry["exit_code"], " (cached)"))
+        self.end("finished")
+        self.report_results()
+        self.scheduler.job_finished(self)
+        return True
+
+    def cancel(self):
+        if self.state == "queued":
+            self.show_placeholder("[Cancelled]")
+        elif self.state == "starting":
+            # The launcher kills the process once it's spawned
+            self.clear_placeholder()
+            self.append_string(None, "[Cancelled]")
+        elif self.state == "running" and self.proc:
+            self.proc.kill()
+            self.proc = None
+            self.append_string(None, "[Cancelled]")
+        self.end("cancelled")
+
+    def end(self, state):
+        self.state = state
+        self.ended = time.time()
+
+    def is_current(self, proc):
+        if proc and self.state == "starting":
+            self.launched(proc)
         if proc != self.proc:
-            # a second call to exec has been made before the first one
-            # finished, ignore it instead of intermingling the output.
+            # The job has been cancelled, ignore the output of its process
             if proc:
                 proc.kill()
-            return
+            return False
+        return True
 
-        try:
-            str = data.decode(self.encoding)
-        except:
-            str = "[Decode error - output not " + self.encoding + "]\n"
-            proc = None
+    # Decodes each (proc, stream, data) run with the decoder of its stream,
+    # and appends the text of all of them at once
+    def append_data(self, runs):
+        texts = []
+        progress = None
+        for proc, stream, data in runs:
+            if not self.is_current(proc):
+                continue
+
+            decoder, transform = self.stream_state(proc, stream)
+            text = decoder.decode(data)
+            if transform:
+                text = transform.feed(text)
+                progress = transform.progress() or progress
+            texts.append(text)
+        if progress:
+            sublime.status_message(progress)
+        self.append_output("".join(texts))
+
+    # The decoder and transform of the given stream of proc
+    def stream_state(self, proc, stream):
+        state = self.decoders.get((proc, stream))
+        if state is None:
+            if self.filters:
+                transform = OutputTransform(self.filters)
+            else:
+                transform = None
+            decoder = StreamDecoder(self.encoding,
+                translate_cr=not (transform and transform.carriage_return))
+            state = self.decoders[(proc, stream)] = (decoder, transform)
+        return state
+
+    # Appends the output of the process
+    def append_output(self, text):
+        self.append_text(text)
+        self.index_results(text)
+        if self.cache_output is not None:
+            self.cache_output.append(text)
+
+    def index_results(self, text):
+        if self.result_index:
+            count = len(self.result_index.results)
+            self.result_index.feed(text)
+            if len(self.result_index.results) != count:
+                sublime.status_message("Building (%d errors)" % len(self.result_index.results))
+
+    def append_string(self, proc, str):
+        if not self.is_current(proc):
+            return
 
         # Normalize newlines, Sublime Text always uses a single \n separator
         # in memory.
-        str = str.replace('\r\n', '\n').replace('\r', '\n')
+        self.append_text(str.replace('\r\n', '\n').replace('\r', '\n'))
 
-        self.output_view.run_command('append', {'characters': str, 'force': True, 'scroll_to_end': True})
+    def append_text(self, str):
+        if str:
+            start = time.time()
+            self.output_view.run_command('append', {'characters': str, 'force': True, 'scroll_to_end': True})
+            self.metrics.on_append(time.time() - start)
+            self.scrollback.append(str)
 
-    def append_string(self, proc, str):
-        self.append_data(proc, str.encode(self.encoding))
+    # Flush the decoders and transforms of proc, emitting any trailing \r,
+    # incomplete multibyte sequence or held back line
+    def finish_decoders(self, proc):
+        for key in [key for key in self.decoders if key[0] == proc]:
+            decoder, transform = self.decoders.pop(key)
+            if self.is_current(proc):
+                text = decoder.decode(b"", True)
+                if transform:
+                    text = transform.feed(text) + transform.finish()
+                self.append_output(text)
 
     def finish(self, proc):
+        # Deliver any output still waiting for the next flush, so it
+        # appears before the [Finished] line
+        self.output_buffer.flush()
+        self.finish_decoders(proc)
+
+        elapsed = time.time() - proc.start_time
+        exit_code = proc.exit_code()
+        usage = proc.resource_usage()
         if not self.quiet:
-            elapsed = time.time() - proc.start_time
-            exit_code = proc.exit_code()
-            if exit_code == 0 or exit_code == None:
-                self.append_string(proc,
-                    ("[Finished in %.1fs]" % (elapsed)))
-            else:
-                self.append_string(proc, ("[Finished in %.1fs with exit code %d]\n"
-                    % (elapsed, exit_code)))
-                # self.append_string(proc, self.debug_text)
+            self.append_string(proc, self.finished_message(elapsed, exit_code, usage_note(usage)))
+            # self.append_string(proc, self.debug_text)
 
         if proc != self.proc:
             return
 
-        errs = self.output_view.find_all_results()
+        self.end("finished")
+        self.scrollback.flush()
+
+        if self.result_index:
+            self.result_index.finish()
+        self.report_results()
+
+        if self.cache_output is not None:
+            get_build_cache().put(self.cache_key, {
+                "output": "".join(self.cache_output),
+                "exit_code": exit_code,
+                "results": self.result_index.results if self.result_index else [],
+            })
+            self.cache_output = None
+
+        if self.log_metrics:
+            record = self.metrics.record(self, exit_code)
+            record["rusage"] = usage
+            write_metrics(record)
+
+        self.scheduler.job_finished(self)
+
+    def finished_message(self, elapsed, exit_code, note=""):
+        if exit_code == 0 or exit_code == None:
+            return "[Finished in %.1fs%s]" % (elapsed, note)
+        else:
+            return "[Finished in %.1fs%s with exit code %d]\n" % (elapsed, note, exit_code)
+
+    def report_results(self):
+        if self.result_index:
+            errs = self.result_index.results
+        else:
+            errs = self.output_view.find_all_results()
         if len(errs) == 0:
             sublime.status_message("Build finished")
         else:
             sublime.status_message(("Build finished with %d errors") % len(errs))
 
     def on_data(self, proc, data):
-        sublime.set_timeout(functools.partial(self.append_data, proc, data), 0)
+        self.metrics.on_read("stdout", len(data))
+        self.output_buffer.write(proc, data)
+
+    def on_stream_data(self, proc, stream, data):
+        self.metrics.on_read(stream, len(data))
+        self.output_buffer.write(proc, data, stream)
 
     def on_finished(self, proc):
         sublime.set_timeout(functools.partial(self.finish, proc), 0)
 
+# Runs the build jobs of one window, at most max_jobs at a time. Each output
+# panel shows one job, a job started in the panel of another one that is
+# still queued or running cancels it. All methods run on the UI thread
+class BuildScheduler(object):
+    def __init__(self, window):
+        self.window = window
+        self.queue = []
+        self.running = []
+        # The last job of each panel, by panel name
+        self.jobs = {}
+        self.last_job = None
+        self.batch_start = None
+        self.batch_size = 0
+
+    def max_jobs(self):
+        settings = sublime.load_settings("Preferences.sublime-settings")
+        return max(1, settings.get("exec_max_jobs", cpu_count()))
+
+    def submit(self, job):
+        previous = self.jobs.get(job.panel)
+        if previous:
+            self.cancel(previous)
+            if previous.scrollback:
+                previous.scrollback.discard()
+
+        if not self.queue and not self.running:
+            self.batch_start = time.time()
+            self.batch_size = 0
+        self.batch_size += 1
+
+        job.scheduler = self
+        self.jobs[job.panel] = job
+        self.last_job = job
+        self.queue.append(job)
+        self.start_jobs()
+        if job.state == "queued":
+            job.show_placeholder("[Queued]")
+
+    def start_jobs(self):
+        while self.queue and len(self.running) < self.max_jobs():
+            job = self.queue.pop(0)
+            self.running.append(job)
+            job.start()
+
+    def cancel(self, job):
+        if job in self.queue:
+            self.queue.remove(job)
+            job.cancel()
+        elif job in self.running:
+            job.cancel()
+            self.job_finished(job)
+
+    def cancel_all(self):
+        for job in self.queue + self.running:
+            self.cancel(job)
+
+    # Cancels every job and deletes their spill files, once the window is
+    # gone
+    def discard(self):
+        self.cancel_all()
+        for job in self.jobs.values():
+            if job.scrollback:
+                job.scrollback.discard()
+        self.jobs = {}
+        self.last_job = None
+
+    def active_jobs(self):
+        return self.running + self.queue
+
+    def job_finished(self, job):
+        if job in self.running:
+            self.running.remove(job)
+        self.start_jobs()
+
+        if (not self.queue and not self.running and self.batch_size > 1
+                and job.state == "finished"):
+            elapsed = time.time() - self.batch_start
+            message = "All %d builds finished in %.1fs" % (self.batch_size, elapsed)
+            print("[exec] " + message)
+            sublime.status_message(message)
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def usage_note(usage):
+    if not usage:
+        return ""
+    note = " (%.1fs user, %.1fs sys" % (usage["user"], usage["sys"])
+    if usage["maxrss"]:
+        note += ", %.1f MB peak RSS" % (usage["maxrss"] / 1e6)
+    if usage["processes"]:
+        note += ", %d processes" % usage["processes"]
+    return note + ")"
+
+# BuildSchedulers by window id
+schedulers = {}
+
+def get_scheduler(window):
+    scheduler = schedulers.get(window.id())
+    if not scheduler:
+        # Only Sublime Text 4 tells about closed windows, drop the jobs of
+        # the closed ones whenever a window starts building
+        open_windows = set(w.id() for w in sublime.windows())
+        for window_id in list(schedulers):
+            if window_id not in open_windows:
+                drop_scheduler(window_id)
+        scheduler = schedulers[window.id()] = BuildScheduler(window)
+    return scheduler
+
+def drop_scheduler(window_id):
+    scheduler = schedulers.pop(window_id, None)
+    if scheduler:
+        scheduler.discard()
+
+# The job shown in the given panel, or the last started one
+def get_job(window, panel=None):
+    scheduler = get_scheduler(window)
+    if panel:
+        return scheduler.jobs.get(panel)
+    return scheduler.last_job
+
+# Default globs of watch mode, and the files and directories it ignores:
+# editor and VCS files, and the usual build output directories
+WATCH_PATTERNS = ["*"]
+WATCH_EXCLUDE = [".*", "*~", "*.pyc", "*.o", "*.obj", "*.log", "__pycache__",
+    "node_modules", "build", "dist", "out", "target"]
+
+# Watches the files under root matching patterns on a thread of its own,
+# calling callback once changes stop for debounce seconds, so a checkout or
+# a formatter run touching many files causes one rebuild. Changes seen while
+# busy() is true are dropped. The tree is walked on the watcher thread, by
+# an InotifySource on Linux and a PollingSource elsewhere
+class FileWatcher(object):
+    def __init__(self, root, patterns, exclude, debounce, callback, busy=None):
+        self.root = root
+        self.patterns = patterns
+        self.exclude = exclude
+        self.debounce = debounce
+        self.callback = callback
+        self.busy = busy or (lambda: False)
+        self.stopped = False
+        self.event = threading.Event()
+        self.source = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.event.set()
+        source = self.source
+        if source:
+            source.wake()
+
+    def excluded(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.exclude)
+
+    def matches(self, path):
+        relpath = os.path.relpath(path, self.root).replace(os.sep, "/")
+        if any(self.excluded(name) for name in relpath.split("/")):
+            return False
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(name, pattern)
+            for pattern in self.patterns)
+
+    # The directories under root that aren't excluded
+    def directories(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not self.excluded(d)]
+            yield dirpath, filenames
+
+    def run(self):
+        try:
+            source = InotifySource(self)
+        except (OSError, AttributeError) as e:
+            print("[exec] watching by polling: " + str(e))
+            source = PollingSource(self)
+        self.source = source
+
+        try:
+            pending = False
+            while not self.stopped:
+                changed = source.wait(self.debounce if pending else None)
+                if self.stopped:
+                    break
+                if changed and not self.busy():
+                    pending = True
+                elif pending and not changed:
+                    pending = False
+                    self.callback()
+        finally:
+            self.source = None
+            source.close()
+
+# Compares the size and mtime of the matching files every INTERVAL seconds
+class PollingSource(object):
+    INTERVAL = 1.0
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for dirpath, filenames in self.watcher.directories():
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if not self.watcher.matches(path):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    # Waits up to timeout seconds (forever if None), returning True if a
+    # matching file changed
+    def wait(self, timeout):
+        self.watcher.event.wait(max(timeout or 0, self.INTERVAL))
+        if self.watcher.stopped:
+            return False
+        snapshot = self.scan()
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        return changed
+
+    def wake(self):
+        # FileWatcher.stop sets the event wait() waits for
+        pass
+
+    def close(self):
+        pass
+
+# Uses inotify through ctypes, watching each directory of the tree. Raises
+# OSError where inotify isn't available or runs out of watches
+class InotifySource(object):
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, watcher):
+        import ctypes, ctypes.util, struct
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.watcher = watcher
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.header = struct.Struct("iIII")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.closed = False
+        self.dirs = {}
+        try:
+            for dirpath, filenames in watcher.directories():
+                self.add_watch(dirpath)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: " + path)
+        self.dirs[wd] = path
+
+    def wake(self):
+        if not self.closed:
+            try:
+                os.write(self.wakeup_w, b"x")
+            except OSError:
+                pass
+
+    def close(self):
+        self.closed = True
+        for fd in (self.fd, self.wakeup_r, self.wakeup_w):
+            os.close(fd)
+
+    def wait(self, timeout):
+        readable = select.select([self.fd, self.wakeup_r], [], [], timeout)[0]
+        if self.wakeup_r in readable or not readable:
+            return False
+
+        data = os.read(self.fd, 2**16)
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.header.unpack_from(data, offset)
+            offset += self.header.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding(), "replace")
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                changed = True
+                continue
+            if wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[wd], name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and not self.watcher.excluded(name):
+                    try:
+                        self.add_watch(path)
+                    except OSError as e:
+                        print("[exec] " + str(e))
+            elif self.watcher.matches(path):
+                changed = True
+        return changed
+
+# Reruns a build when the files it watches change. With the default policy
+# "ignore", changes made while the build starts or runs are dropped, they
+# are mostly its own output. Files saved in Sublime Text meanwhile aren't,
+# they rerun the build once it's over. "cancel" restarts a running build
+# instead and "queue" waits for it to finish; both need the outputs to be
+# excluded
+class BuildWatcher(object):
+    # Seconds changes are still dropped after the build ended, its last
+    # writes can be seen after the job's state changed, by polling up to an
+    # INTERVAL later
+    SETTLE = 2.0
+
+    def __init__(self, window, panel, args, options):
+        settings = sublime.load_settings("Preferences.sublime-settings")
+        if not isinstance(options, dict):
+            options = {}
+        self.window = window
+        self.panel = panel
+        self.args = args
+        self.policy = options.get("policy", settings.get("exec_watch_policy", "ignore"))
+        self.debounce = options.get("debounce", settings.get("exec_watch_debounce", 200))
+        # A file was saved while busy
+        self.dirty = False
+
+        self.watcher = FileWatcher(args["working_dir"],
+            options.get("patterns", WATCH_PATTERNS),
+            options.get("exclude", WATCH_EXCLUDE),
+            self.debounce / 1000.0,
+            lambda: sublime.set_timeout(self.rebuild, 0),
+            self.busy)
+        self.watcher.start()
+
+    def stop(self):
+        self.watcher.stop()
+
+    def job_active(self):
+        job = get_scheduler(self.window).jobs.get(self.panel)
+        return job is not None and job.state in ("queued", "starting", "running")
+
+    # Called on the watcher thread too
+    def busy(self):
+        if self.policy != "ignore":
+            return False
+        job = get_scheduler(self.window).jobs.get(self.panel)
+        if job is None:
+            return False
+        if job.state in ("queued", "starting", "running"):
+            return True
+        return job.ended is not None and time.time() - job.ended < self.SETTLE
+
+    # Called by ExecEventListener for each file saved in Sublime Text, the
+    # build doesn't write through the editor
+    def on_saved(self, path):
+        try:
+            relpath = os.path.relpath(path, self.watcher.root)
+        except ValueError:
+            # On another drive
+            return
+        if relpath.startswith(os.pardir) or not self.watcher.matches(path):
+            return
+        if self.busy() and not self.dirty:
+            self.dirty = True
+            sublime.set_timeout(self.rebuild_dirty, self.debounce)
+
+    def rebuild_dirty(self):
+        if self.watcher.stopped:
+            return
+        if self.busy():
+            sublime.set_timeout(self.rebuild_dirty, self.debounce)
+            return
+        self.dirty = False
+        self.rebuild()
+
+    def rebuild(self):
+        if self.watcher.stopped or self.busy():
+            return
+
+        if self.policy == "queue" and self.job_active():
+            sublime.set_timeout(self.rebuild, self.debounce)
+            return
+
+        args = dict(self.args)
+        args["panel"] = self.panel
+        self.window.run_command("exec", args)
+
+# BuildWatchers by (window id, panel)
+watchers = {}
+
+def stop_watch(window, panel=None):
+    for key in list(watchers):
+        if key[0] == window.id() and (panel is None or key[1] == panel):
+            watchers.pop(key).stop()
+
+# The watcher threads, idle shells, jobs and their spill files outlive a
+# reload of the plugin, the new module can't reach them anymore
+def plugin_unloaded():
+    for watcher in list(watchers.values()):
+        watcher.stop()
+    watchers.clear()
+    worker_pool.clear()
+    for window_id in list(schedulers):
+        drop_scheduler(window_id)
+
+class ExecCommand(sublime_plugin.WindowCommand):
+    def run(self, kill = False,
+            # Name of the output panel, builds in different panels run
+            # concurrently
+            panel = None,
+            # Rebuild when files under working_dir change: true, or a dict
+            # with "patterns", "exclude", "debounce" (ms) and "policy", see
+            # BuildWatcher
+            watch = False,
+            # Catches the build system options, see BuildJob
+            **kwargs):
+
+        scheduler = get_scheduler(self.window)
+        if kill:
+            # Cancelling a build stops watching for it as well
+            stop_watch(self.window, panel)
+            if panel:
+                job = scheduler.jobs.get(panel)
+                if job:
+                    scheduler.cancel(job)
+            else:
+                scheduler.cancel_all()
+            return
+
+        # Default the to the current files directory if no working directory was given
+        if (not kwargs.get("working_dir") and self.window.active_view()
+                        and self.window.active_view().file_name()):
+            kwargs["working_dir"] = os.path.dirname(self.window.active_view().file_name())
+
+        job = BuildJob(self.window, panel or "exec", **kwargs)
+
+        show_panel_on_build = sublime.load_settings("Preferences.sublime-settings").get("show_panel_on_build", True)
+        if show_panel_on_build:
+            self.window.run_command("show_panel", {"panel": "output." + job.panel})
+
+        scheduler.submit(job)
+
+        if watch:
+            stop_watch(self.window, job.panel)
+            if kwargs.get("working_dir"):
+                watchers[(self.window.id(), job.panel)] = BuildWatcher(
+                    self.window, job.panel, kwargs, watch)
+            else:
+                sublime.status_message("Can't watch a build without a working_dir")
+
+    def is_enabled(self, kill = False, **kwargs):
+        if kill:
+            return (len(get_scheduler(self.window).active_jobs()) > 0
+                or any(key[0] == self.window.id() for key in watchers))
+        else:
+            return True
+
+class ExecStopWatchCommand(sublime_plugin.WindowCommand):
+    def run(self, panel = None):
+        stop_watch(self.window, panel)
+        sublime.status_message("Stopped watching")
+
+    def is_enabled(self, panel = None):
+        return any(key[0] == self.window.id() and (panel is None or key[1] == panel)
+            for key in watchers)
+
+class ExecEventListener(sublime_plugin.EventListener):
+    def on_post_save(self, view):
+        path = view.file_name()
+        if path:
+            for watcher in list(watchers.values()):
+                watcher.on_saved(path)
+
+    # Sublime Text 4 only, see get_scheduler
+    def on_pre_close_window(self, window):
+        stop_watch(window)
+        drop_scheduler(window.id())
+
+class ExecCancelJobCommand(sublime_plugin.WindowCommand):
+    def run(self, panel = None):
+        scheduler = get_scheduler(self.window)
+        if panel:
+            job = scheduler.jobs.get(panel)
+            if job:
+                scheduler.cancel(job)
+            return
+
+        jobs = scheduler.active_jobs()
+        items = [[job.name(), "%s (%s)" % (job.panel, job.state)] for job in jobs]
+
+        def on_done(index):
+            if index >= 0:
+                scheduler.cancel(jobs[index])
+
+        self.window.show_quick_panel(items, on_done)
+
+    def is_enabled(self, panel = None):
+        return len(get_scheduler(self.window).active_jobs()) > 0
+
+class ExecClearCacheCommand(sublime_plugin.ApplicationCommand):
+    def run(self):
+        get_build_cache().clear()
+        sublime.status_message("Build cache cleared")
+
+class ExecMetricsSummaryCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        builds = {}
+        for record in read_metrics():
+            builds.setdefault(record["command"], []).append(record)
+
+        def average(records, name):
+            values = [r[name] for r in records if r.get(name) is not None]
+            return sum(values) / len(values) if values else 0.0
+
+        lines = []
+        for command, records in sorted(builds.items()):
+            failed = len([r for r in records if r["exit_code"]])
+            total_bytes = sum(sum(r["bytes"].values()) for r in records)
+            lines.append(command)
+            lines.append("  builds: %d (%d failed), output: %.1f KiB per build" % (
+                len(records), failed, total_bytes / 1024.0 / len(records)))
+            lines.append("  wall: %.3fs, spawn: %.3fs, first byte: %.3fs" % (
+                average(records, "wall"), average(records, "spawn"), average(records, "first_byte")))
+            lines.append("  read: %.1f MB/s, dispatch lag: %.1fms (max %.1fms), append: %.3fs in %.0f appends" % (
+                average(records, "throughput") / 1e6, average(records, "dispatch_lag") * 1000,
+                max(r["max_dispatch_lag"] for r in records) * 1000,
+                average(records, "append_time"), average(records, "appends")))
+        if not lines:
+            lines.append("No build metrics recorded in " + metrics_log_path())
+
+        if hasattr(self.window, 'create_output_panel'):
+            view = self.window.create_output_panel("exec_metrics")
+        else:
+            view = self.window.get_output_panel("exec_metrics")
+        view.run_command('append', {'characters': "\n".join(lines) + "\n", 'force': True})
+        self.window.run_command("show_panel", {"panel": "output.exec_metrics"})
+
+class ExecTrimOutputCommand(sublime_plugin.TextCommand):
+    def run(self, edit, end, marker=""):
+        self.view.replace(edit, sublime.Region(0, end), marker)
+
+class ExecOpenSpillCommand(sublime_plugin.WindowCommand):
+    def run(self, panel = None):
+        scrollback = get_job(self.window, panel).scrollback
+        scrollback.flush()
+        view = self.window.open_file(scrollback.path)
+
+        # Make the results that were trimmed from the panel navigable in the
+        # spill file
+        settings = scrollback.view.settings()
+        for name in ("result_file_regex", "result_line_regex", "result_base_dir"):
+            view.settings().set(name, settings.get(name))
+
+    def is_enabled(self, panel = None):
+        job = get_job(self.window, panel)
+        return bool(job and job.scrollback and job.scrollback.spill)
+
+class ExecShowResultsCommand(sublime_plugin.WindowCommand):
+    def run(self, panel = None):
+        results = get_job(self.window, panel).result_index.results
+        items = []
+        for file, row, col, message in results:
+            items.append(["%s:%d:%d" % (file, row, col), message])
+
+        def on_done(index):
+            if index >= 0:
+                file, row, col = results[index][:3]
+                self.window.open_file("%s:%d:%d" % (file, row, col),
+                    sublime.ENCODED_POSITION)
+
+        self.window.show_quick_panel(items, on_done)
+
+    def is_enabled(self, panel = None):
+        job = get_job(self.window, panel)
+        return bool(job and job.result_index and job.result_index.results)
+
 
 if int(sublime.version()) < 3000:
     class AppendCommand(sublime_plugin.TextCommand):
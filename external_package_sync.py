@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 # This script should not depend any module except standard library.
+# shutil, subprocess and tempfile are imported where used, the plugin host
+# loads this file on every start.
 import os
 import sys
 import glob
-import shutil
-import subprocess
+import fnmatch
+import re
+import threading
+import time
 from os.path import expandvars, expanduser, join, abspath, relpath, exists
-from os.path import basename, dirname, normcase, splitext, islink
+from os.path import basename, dirname, normcase, splitext, islink, isdir
 
 
 USERVARS = 'UserVariable.sublime-settings'
@@ -73,9 +77,11 @@ repo_base = None
 packages_path = None
 
 
-# Hide the console window on Windows
-startupinfo = None
-if os.name == "nt":
+def hidden_startupinfo():
+    # Hide the console window on Windows
+    import subprocess
+    if os.name != "nt":
+        return None
     startupinfo = subprocess.STARTUPINFO()
     if hasattr(subprocess, 'STARTF_USESHOWWINDOW'):
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
@@ -83,6 +89,7 @@ if os.name == "nt":
         # Workaround for Python 2.7
         import _subprocess
         startupinfo.dwFlags |= _subprocess.STARTF_USESHOWWINDOW
+    return startupinfo
 
 
 def init(packages=None):
@@ -107,8 +114,10 @@ def init(packages=None):
     try:
         import sublime
         settings = sublime.load_settings(USERVARS)
-        settings.set('user_packages_path', repo_base)
-        sublime.save_settings(USERVARS)
+        # Saving rewrites the file and makes Sublime Text reload it
+        if settings.get('user_packages_path') != repo_base:
+            settings.set('user_packages_path', repo_base)
+            sublime.save_settings(USERVARS)
     except ImportError:
         pass
 
@@ -175,19 +184,42 @@ def load_json(fname):
     return json.JSONDecoder(strict=False).decode(text)
 
 
+# (mtime, result) by (function name, path)
+mtime_cache = {}
+
+
+def load_cached(path, load):
+    # Call load(path) again only when the mtime of path changed. Like
+    # TreeManifest, a path modified within RACY seconds may change again
+    # without its mtime changing, its result isn't trusted next time
+    now = time.time()
+    mtime = os.stat(path).st_mtime
+    key = (load.__name__, path)
+    cached = mtime_cache.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    result = load(path)
+    if now - mtime < TreeManifest.RACY:
+        mtime = None
+    mtime_cache[key] = (mtime, result)
+    return result
+
+
+def list_dir(path):
+    return [name for name in os.listdir(path) if not name.startswith('.')]
+
+
 def repository_packages():
-    packages = glob.glob(join(repo_base, '*'))
-    return [basename(i) for i in packages]
+    return list(load_cached(repo_base, list_dir))
 
 
 def all_packages():
-    packages = glob.glob(join(packages_path, '*'))
-    return [basename(i) for i in packages]
+    return list(load_cached(packages_path, list_dir))
 
 
 def installed_packages():
-    settings = load_json(join(packages_path, 'User', 'Package Control.sublime-settings'))
-    return settings['installed_packages']
+    settings = load_cached(join(packages_path, 'User', 'Package Control.sublime-settings'), load_json)
+    return list(settings['installed_packages'])
 
 
 def pristine_packages():
@@ -215,7 +247,7 @@ def package_sync_status():
     packages = all_packages()
     installed = installed_packages()
     pristine = pristine_packages()
-    additional_exclude_packages = config['additional_exclude_packages'].get('all', [])
+    additional_exclude_packages = list(config['additional_exclude_packages'].get('all', []))
     additional_exclude_packages += config['additional_exclude_packages'].get(os.name, [])
     exclude = list(set(pristine) | set(installed) | set(additional_exclude_packages))
     not_package_controled = list(set(packages) - set(pristine) - set(installed))
@@ -233,13 +265,18 @@ def package_sync_status():
 
 
 def execute_sync(src, dest, dest_exclude=[]):
+    if os.name != 'nt':
+        mirror(src, dest, dest_exclude)
+        return
+
+    import subprocess
     try:
         extra = []
         if dry_run:
             extra.append('/L')
         dest_exclude = [join(dest, i) for i in dest_exclude]
         cmd = ['robocopy', src, dest, '/mir'] + extra + config['exclude_options'] + ['/xd'] + dest_exclude
-        subprocess.check_call(cmd, startupinfo=startupinfo)
+        subprocess.check_call(cmd, startupinfo=hidden_startupinfo())
     except subprocess.CalledProcessError as e:
         if e.returncode > 3:
             error_message(
@@ -249,34 +286,820 @@ def execute_sync(src, dest, dest_exclude=[]):
             raise
 
 
-def sync_link(src, dest, add, remove):
-    for name in remove:
-        path = join(dest, name)
-        if islink(path):
-            os.unlink(path)
+def exclude_patterns():
+    # Split config['exclude_options'] into the /xd and /xf lists of robocopy
+    dirs = []
+    files = []
+    current = None
+    for option in config['exclude_options']:
+        if option.lower() == '/xd':
+            current = dirs
+        elif option.lower() == '/xf':
+            current = files
+        elif current is not None:
+            current.append(option)
+    return dirs, files
+
+
+class ExcludeRules(object):
+    # A list of robocopy exclusions compiled for matching many paths: names
+    # without wildcards in a set, the wildcards merged into one regex and
+    # patterns containing a separator compared to the whole path
+
+    def __init__(self, patterns):
+        self.names = set()
+        self.paths = set()
+        globs = []
+        for pattern in patterns:
+            if os.sep in pattern or '/' in pattern:
+                self.paths.add(normcase(abspath(pattern)))
+            elif any(c in pattern for c in '*?['):
+                globs.append(fnmatch.translate(normcase(pattern)))
+            else:
+                self.names.add(normcase(pattern))
+        self.regex = None
+        if globs:
+            self.regex = re.compile('|'.join('(?:%s)' % g for g in globs))
+
+    def match(self, path):
+        name = normcase(basename(path))
+        if name in self.names:
+            return True
+        if self.regex and self.regex.match(name):
+            return True
+        return bool(self.paths) and normcase(abspath(path)) in self.paths
+
+
+class ExcludeMatcher(object):
+    # config['exclude_options'] plus the given paths to exclude, as the
+    # directory and file rules of robocopy /xd and /xf
+
+    def __init__(self, exclude_paths=[]):
+        dirs, files = exclude_patterns()
+        self.dirs = ExcludeRules(dirs + list(exclude_paths))
+        self.files = ExcludeRules(files)
+
+    def exclude_dir(self, path):
+        return self.dirs.match(path)
+
+    def exclude_file(self, path):
+        return self.files.match(path)
+
+
+# Files of MMAP_THRESHOLD bytes or more are hashed by blocks of BLOCK_SIZE
+# through mmap, their digest is the digest of the list of block digests
+BLOCK_SIZE = 2 ** 20
+MMAP_THRESHOLD = 2 ** 22
+# Bytes of blocks queued or being hashed at once
+MAX_IN_FLIGHT = 2 ** 26
+
+
+def file_digest(path):
+    import hashlib
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def combine_digests(blocks):
+    import hashlib
+    return hashlib.sha1(''.join(blocks).encode('ascii')).hexdigest()
+
+
+class HashService(object):
+    # Hashes the blocks of large files on a thread pool; hashlib releases
+    # the GIL, so threads are enough. Submitting waits while MAX_IN_FLIGHT
+    # bytes are pending
+
+    def __init__(self, workers=4, max_in_flight=MAX_IN_FLIGHT):
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.executor = None
+
+    def pool(self):
+        if self.executor is None:
+            try:
+                from concurrent.futures import ThreadPoolExecutor
+            except ImportError:
+                # Python 2.6 (Sublime Text 2), hash in the calling thread
+                self.executor = False
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def acquire(self, size):
+        with self.cond:
+            while self.in_flight and self.in_flight + size > self.max_in_flight:
+                self.cond.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self.cond:
+            self.in_flight -= size
+            self.cond.notify_all()
+
+    def hash_block(self, mm, offset, size):
+        import hashlib
+        try:
+            try:
+                view = memoryview(mm)
+            except TypeError:
+                # Python 2 can't take a memoryview of an mmap
+                return hashlib.sha1(mm[offset:offset + size]).hexdigest()
+            try:
+                return hashlib.sha1(view[offset:offset + size]).hexdigest()
+            finally:
+                view.release()
+        finally:
+            self.release(size)
+
+    def hash_file(self, path):
+        # Returns (digest, block digests), the block digests are None for
+        # files smaller than MMAP_THRESHOLD
+        import mmap
+        size = os.path.getsize(path)
+        if size < MMAP_THRESHOLD:
+            return file_digest(path), None
+
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pool = self.pool()
+        futures = []
+        blocks = []
+        try:
+            for offset in range(0, size, BLOCK_SIZE):
+                length = min(BLOCK_SIZE, size - offset)
+                self.acquire(length)
+                if pool:
+                    futures.append(pool.submit(self.hash_block, mm, offset, length))
+                else:
+                    blocks.append(self.hash_block(mm, offset, length))
+        finally:
+            if futures:
+                from concurrent.futures import wait
+                wait(futures)
+            mm.close()
+        blocks += [future.result() for future in futures]
+        return combine_digests(blocks), blocks
+
+
+hash_service = HashService()
+
+
+def stat_key(st):
+    # Python 2 has no st_mtime_ns
+    return (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino)
+
+
+class FingerprintCache(object):
+    # Digests of files by path, with the block digests of large files,
+    # valid while (size, mtime_ns, inode) of the file is unchanged. Kept up
+    # to date by copy_file, so comparing synced files is a stat and a lookup
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, path):
+        try:
+            key = stat_key(os.stat(path))
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry[0] == key:
+            return entry[1:]
+        return None
+
+    def lookup(self, path):
+        entry = self.get(path)
+        return entry[0] if entry else None
+
+    def store(self, path, digest, st=None, blocks=None):
+        try:
+            key = stat_key(st or os.stat(path))
+        except OSError:
+            return
+        with self.lock:
+            self.entries[path] = (key, digest, blocks)
+
+    def hash(self, path):
+        # Returns (digest, block digests)
+        entry = self.get(path)
+        if entry is None:
+            # Stat first, a change while hashing makes the entry stale
+            st = os.stat(path)
+            entry = hash_service.hash_file(path)
+            self.store(path, entry[0], st, entry[1])
+        return entry
+
+    def digest(self, path):
+        return self.hash(path)[0]
+
+    def prefetch(self, paths):
+        # Hash paths on a background thread
+        def run():
+            for path in paths:
+                try:
+                    self.digest(path)
+                except (IOError, OSError):
+                    pass
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def same(self, a, b):
+        # True or False if the cache can tell, None if hashing is needed
+        try:
+            if os.stat(a).st_size != os.stat(b).st_size:
+                return False
+        except OSError:
+            return False
+        digest_a = self.lookup(a)
+        digest_b = self.lookup(b)
+        if digest_a is None or digest_b is None:
+            return None
+        return digest_a == digest_b
+
+
+fingerprints = FingerprintCache()
+
 
-    for name in add:
-        os.symlink(join(src, name), join(dest, name))
+# Libraries and executables may be mapped by a running process, writing into
+# them would corrupt it (or fail with ETXTBSY), they are always replaced
+UNPATCHABLE = ('.dll', '.exe', '.so', '.dylib', '.pyd', '.node')
+
+
+def patchable(dest):
+    import stat
+    if normcase(dest).endswith(UNPATCHABLE) or '.so.' in basename(dest):
+        return False
+    try:
+        mode = os.stat(dest).st_mode
+    except OSError:
+        return False
+    return not mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def patch_file(src, dest, st):
+    # Rewrite in place only the blocks of a large dest that differ from src.
+    # Returns False when both aren't hashed by blocks
+    import shutil
+    digest, blocks = fingerprints.hash(src)
+    dest_blocks = fingerprints.hash(dest)[1]
+    if blocks is None or dest_blocks is None:
+        return False
+    if stat_key(os.stat(src)) != stat_key(st):
+        # Changed while hashing
+        return False
+
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'r+b') as fdest:
+            for i, block in enumerate(blocks):
+                if i < len(dest_blocks) and dest_blocks[i] == block:
+                    continue
+                fsrc.seek(i * BLOCK_SIZE)
+                fdest.seek(i * BLOCK_SIZE)
+                fdest.write(fsrc.read(BLOCK_SIZE))
+            fdest.truncate(st.st_size)
+    shutil.copystat(src, dest)
+    fingerprints.store(src, digest, st, blocks)
+    fingerprints.store(dest, digest, None, blocks)
+    return True
+
+
+def copy_file(src, dest):
+    # Copy to a temporary name first, Sublime Text must never load a half
+    # written plugin. Large data files (fonts, archives) that exist in dest
+    # are patched in place instead, libraries and executables aren't. The
+    # content is hashed on the way into fingerprints. The temporary name is
+    # unique, sync_all_packages and sync_files can copy the same file at once
+    import hashlib
+    import shutil
+    import tempfile
+    st = os.stat(src)
+    large = st.st_size >= MMAP_THRESHOLD
+    if large and exists(dest) and not islink(dest) and patchable(dest):
+        try:
+            if patch_file(src, dest, st):
+                return
+        except (IOError, OSError) as e:
+            # A partly patched dest is replaced below
+            print('external_package_sync: patching failed, copying: ' + str(e))
+
+    fd, tmp = tempfile.mkstemp(suffix='.sync-tmp', prefix=basename(dest) + '.',
+                               dir=dirname(dest))
+    digest = hashlib.sha1()
+    blocks = []
+    try:
+        with open(src, 'rb') as fsrc:
+            with os.fdopen(fd, 'wb') as fdest:
+                for block in iter(lambda: fsrc.read(BLOCK_SIZE), b''):
+                    if large:
+                        blocks.append(hashlib.sha1(block).hexdigest())
+                    else:
+                        digest.update(block)
+                    fdest.write(block)
+        shutil.copystat(src, tmp)
+        if os.name == 'nt' and exists(dest):
+            os.remove(dest)
+        os.rename(tmp, dest)
+    except (IOError, OSError):
+        if exists(tmp):
+            os.remove(tmp)
+        raise
+    if large:
+        digest = combine_digests(blocks)
+    else:
+        digest = digest.hexdigest()
+        blocks = None
+    fingerprints.store(src, digest, st, blocks)
+    fingerprints.store(dest, digest, None, blocks)
+
+
+def remove_path(path):
+    import shutil
+    if islink(path) or not isdir(path):
+        os.remove(path)
+    else:
+        shutil.rmtree(path)
+
+
+def manifest_path(root):
+    # Manifests live in the cache directory of Sublime Text, or in the temp
+    # directory when running outside of it
+    import hashlib
+    try:
+        import sublime
+        base = sublime.cache_path()
+    except (ImportError, AttributeError):
+        import tempfile
+        base = tempfile.gettempdir()
+    name = hashlib.sha1(normcase(abspath(root)).encode('utf-8')).hexdigest()
+    return join(base, 'external_package_sync', name + '.json')
+
+
+class TreeManifest(object):
+    # A persisted listing of a tree. For each directory (relative to root,
+    # '' is root) it keeps its mtime, its subdirectories, its symlinks and
+    # [size, mtime, inode, digest] of its files. update() lists again only
+    # the directories whose mtime changed; a file edited in place doesn't
+    # touch its directory, so files are still stat'ed, but digests survive
+    # as long as the stat does
+
+    # Directories modified this recently may change again within the mtime
+    # resolution, they are listed again on the next update
+    RACY = 2
+
+    def __init__(self, root, path=None):
+        self.root = root
+        self.path = path or manifest_path(root)
+        self.dirs = {}
+        self.load()
+
+    def load(self):
+        import json
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('root') == self.root:
+            self.dirs = data['dirs']
+
+    def save(self):
+        import json
+        if not exists(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'root': self.root, 'dirs': self.dirs}, f)
+        if os.name == 'nt' and exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def full_path(self, rel):
+        return join(self.root, rel) if rel else self.root
+
+    def update(self, prune=None):
+        # Returns the relative paths of the files added or changed since the
+        # last update. prune(path) excludes directories from the manifest
+        changed = []
+        dirs = {}
+        now = time.time()
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            full = self.full_path(rel)
+            try:
+                mtime = os.stat(full).st_mtime
+            except OSError:
+                if not rel:
+                    raise
+                continue
+            old = self.dirs.get(rel)
+            if old and old['mtime'] == mtime:
+                subdirs = old['dirs']
+                links = old['links']
+                names = list(old['files'])
+            else:
+                subdirs = []
+                links = []
+                names = []
+                for name in os.listdir(full):
+                    path = join(full, name)
+                    if islink(path):
+                        links.append(name)
+                    elif isdir(path):
+                        if not (prune and prune(path)):
+                            subdirs.append(name)
+                    else:
+                        names.append(name)
+
+            old_files = old['files'] if old else {}
+            files = {}
+            for name in names:
+                try:
+                    st = os.stat(join(full, name))
+                except OSError:
+                    # Removed since the listing
+                    mtime = None
+                    continue
+                entry = [st.st_size, st.st_mtime, st.st_ino, None]
+                prev = old_files.get(name)
+                if prev and prev[:3] == entry[:3]:
+                    entry[3] = prev[3]
+                else:
+                    changed.append(join(rel, name))
+                files[name] = entry
+
+            if mtime is not None and now - mtime < self.RACY:
+                mtime = None
+            dirs[rel] = {'mtime': mtime, 'dirs': subdirs, 'links': links, 'files': files}
+            stack.extend(join(rel, name) for name in subdirs)
+
+        self.dirs = dirs
+        return changed
+
+    def entry(self, rel):
+        d = self.dirs.get(dirname(rel))
+        if d:
+            return d['files'].get(basename(rel))
+        return None
+
+    def digest(self, rel):
+        entry = self.entry(rel)
+        if entry is None:
+            return fingerprints.digest(self.full_path(rel))
+        if entry[3] is None:
+            entry[3] = fingerprints.digest(self.full_path(rel))
+        return entry[3]
+
+
+# TreeManifests by root
+manifests = {}
+
+
+def get_manifest(root):
+    manifest = manifests.get(root)
+    if not manifest:
+        manifest = manifests[root] = TreeManifest(root)
+    return manifest
+
+
+def mirror_plan(src, dest, matcher, checksum=False):
+    # Compare the TreeManifests of both trees, returning a SyncPlan. Symlinks
+    # are left alone: those already in dest, left over from when packages
+    # were linked into the repository, are only kept in place, never
+    # created, updated or removed
+    plan = SyncPlan(src.root, dest.root)
+    mkdirs = plan.mkdirs
+    removes = plan.removes
+    empty = {'dirs': [], 'links': [], 'files': {}}
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        s_dir = src.dirs[rel]
+        d_dir = dest.dirs.get(rel, empty)
+        d_subdirs = set(d_dir['dirs'])
+        d_links = set(d_dir['links'])
+
+        for name in sorted(s_dir['dirs']):
+            s = src.full_path(join(rel, name))
+            d = dest.full_path(join(rel, name))
+            if matcher.exclude_dir(s) or matcher.exclude_dir(d):
+                continue
+            if name in d_links:
+                continue
+            if name in d_dir['files']:
+                removes.append(d)
+            if name not in d_subdirs:
+                mkdirs.append(d)
+            stack.append(join(rel, name))
+
+        for name in sorted(s_dir['files']):
+            s = src.full_path(join(rel, name))
+            d = dest.full_path(join(rel, name))
+            if matcher.exclude_file(s) or name in d_links:
+                continue
+            size = s_dir['files'][name][0]
+            if name in d_subdirs:
+                removes.append(d)
+                plan.adds.append([s, d, size])
+            elif name not in d_dir['files']:
+                plan.adds.append([s, d, size])
+            elif not same_entry(src, dest, join(rel, name), checksum):
+                plan.updates.append([s, d, size])
+
+        names = set(s_dir['dirs']) | set(s_dir['links']) | set(s_dir['files'])
+        for name in sorted((d_subdirs | d_links | set(d_dir['files'])) - names):
+            d = dest.full_path(join(rel, name))
+            if (matcher.exclude_dir(d) if name in d_subdirs else matcher.exclude_file(d)):
+                continue
+            removes.append(d)
+    return plan
+
+
+def same_entry(src, dest, rel, checksum=False):
+    s = src.entry(rel)
+    d = dest.entry(rel)
+    if s[0] != d[0]:
+        return False
+    if checksum:
+        return src.digest(rel) == dest.digest(rel)
+    return s[1] == d[1]
+
+
+class SyncPlan(object):
+    # What a mirror of src onto dest will do: directories to make, files to
+    # add or update ([src, dest, size]) and paths to remove. apply() records
+    # each completed operation in a journal, so an interrupted sync is
+    # finished by resume() instead of being planned and copied again
+
+    def __init__(self, src, dest):
+        self.src = src
+        self.dest = dest
+        self.mkdirs = []
+        self.adds = []
+        self.updates = []
+        self.removes = []
+
+    def copies(self):
+        return self.adds + self.updates
+
+    def bytes(self):
+        return sum(size for s, d, size in self.copies())
+
+    def empty(self):
+        return not (self.mkdirs or self.adds or self.updates or self.removes)
+
+    def summary(self):
+        return '%d added, %d updated, %d removed, %.1f MB to copy' % (
+            len(self.adds), len(self.updates), len(self.removes), self.bytes() / 1e6)
+
+    def to_dict(self):
+        return {
+            'src': self.src,
+            'dest': self.dest,
+            'mkdirs': self.mkdirs,
+            'adds': self.adds,
+            'updates': self.updates,
+            'removes': self.removes,
+            'bytes': self.bytes(),
+        }
+
+    def to_json(self):
+        import json
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    @classmethod
+    def from_dict(cls, data):
+        plan = cls(data['src'], data['dest'])
+        for name in ['mkdirs', 'adds', 'updates', 'removes']:
+            setattr(plan, name, data[name])
+        return plan
+
+    def operations(self):
+        # Removals first, they may make room for a file replacing a
+        # directory or the reverse
+        return ([('remove', path) for path in self.removes] +
+                [('mkdir', path) for path in self.mkdirs] +
+                [('copy', s, d) for s, d, size in self.copies()])
+
+    def apply(self, workers=8, done=None):
+        import json
+        operations = self.operations()
+        path = journal_path(self.dest)
+        resuming = done is not None
+        if done is None:
+            done = set()
+            if not exists(dirname(path)):
+                os.makedirs(dirname(path))
+            with open(path, 'w') as f:
+                f.write(json.dumps(self.to_dict()) + '\n')
+        journal = open(path, 'a')
+        lock = threading.Lock()
+
+        def run(index):
+            operation = operations[index]
+            if operation[0] == 'remove':
+                if exists(operation[1]) or islink(operation[1]):
+                    remove_path(operation[1])
+            elif operation[0] == 'mkdir':
+                if not isdir(operation[1]):
+                    os.makedirs(operation[1])
+            elif not (resuming and not exists(operation[1])):
+                # A file removed from the repository since the interrupted
+                # sync is left to the plan made after resuming
+                copy_file(operation[1], operation[2])
+            with lock:
+                journal.write('%d\n' % index)
+                journal.flush()
+
+        pending = [i for i in range(len(operations)) if i not in done]
+        try:
+            copies = [i for i in pending if operations[i][0] == 'copy']
+            for i in pending:
+                if operations[i][0] != 'copy':
+                    run(i)
+            try:
+                from concurrent.futures import ThreadPoolExecutor
+            except ImportError:
+                # Python 2.6 (Sublime Text 2)
+                for i in copies:
+                    run(i)
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    # list() raises the first error of the copies
+                    list(executor.map(run, copies))
+        finally:
+            journal.close()
+        os.remove(path)
+
+        if not self.empty():
+            print('external_package_sync: ' + self.summary())
+
+    @classmethod
+    def resume(cls, dest):
+        # Finish the sync onto dest that was interrupted, if any
+        import json
+        path = journal_path(dest)
+        if not exists(path):
+            return None
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+        try:
+            plan = cls.from_dict(json.loads(lines[0]))
+        except (IndexError, ValueError, KeyError):
+            os.remove(path)
+            return None
+        done = set()
+        for line in lines[1:]:
+            try:
+                done.add(int(line))
+            except ValueError:
+                # Cut by the interruption
+                pass
+        print('external_package_sync: resuming sync, %d of %d done' % (
+            len(done), len(plan.operations())))
+        try:
+            plan.apply(done=done)
+        except (IOError, OSError) as e:
+            # Don't let a journal that can't be replayed block every later
+            # sync, the caller plans again from the trees
+            print('external_package_sync: discarding the interrupted sync: ' + str(e))
+            if exists(path):
+                os.remove(path)
+            return None
+        return plan
+
+
+def journal_path(dest):
+    return splitext(manifest_path(dest))[0] + '.journal'
+
+
+def create_plan(src, dest, dest_exclude=[], checksum=False):
+    # The SyncPlan of "robocopy src dest /mir" honoring
+    # config['exclude_options']
+    if not dry_run:
+        SyncPlan.resume(dest)
+    matcher = ExcludeMatcher([join(dest, i) for i in dest_exclude])
+    src_manifest = get_manifest(src)
+    dest_manifest = get_manifest(dest)
+    # Excluded directories are not descended into
+    src_manifest.update(matcher.exclude_dir)
+    dest_manifest.update(matcher.exclude_dir)
+    plan = mirror_plan(src_manifest, dest_manifest, matcher, checksum)
+    # Digests computed by checksum are worth keeping
+    src_manifest.save()
+    dest_manifest.save()
+    return plan
+
+
+def apply_plan(plan, workers=8):
+    if dry_run:
+        print(plan.to_json())
+    else:
+        plan.apply(workers)
+
+
+def mirror(src, dest, dest_exclude=[], checksum=False, workers=8):
+    plan = create_plan(src, dest, dest_exclude, checksum)
+    apply_plan(plan, workers)
+    return plan
 
 
 def sync_all_packages():
     status = package_sync_status()
     on_pre_sync(repo_base, packages_path)
+    # Plan first, so the confirmation can tell what will be copied
+    plan = None
+    if os.name != 'nt':
+        plan = create_plan(repo_base, packages_path, status['exclude'])
     if len(status['add']) > 0 or len(status['remove']) > 0:
         if not input_ok_cancel('\n'.join([
             'external_package_sync: Continue sync?',
             'add: ' + ', '.join(status['add']),
             'remove: ' + ', '.join(status['remove']),
-        ])):
+        ] + (['files: ' + plan.summary()] if plan else []))):
             print('external_package_sync: canceled.')
             return
 
-    if os.name == 'nt':
-        execute_sync(repo_base, packages_path, status['exclude'])
-    elif os.name == 'posix':
-        sync_link(repo_base, packages_path, status['add'], status['remove'])
+    if plan:
+        apply_plan(plan)
     else:
-        raise NotImplementedError()
+        execute_sync(repo_base, packages_path, status['exclude'])
+
+
+def sync_files(paths):
+    # Copy the given files, relative to repo_base, into packages_path.
+    # Packages not synced yet need the confirmation of sync_all_packages
+    status = package_sync_status()
+    matcher = ExcludeMatcher()
+    for rel in paths:
+        parts = rel.split(os.sep)
+        src = join(repo_base, rel)
+        dest = join(packages_path, rel)
+        if parts[0] not in status['sync'] or parts[0] in status['exclude']:
+            print('external_package_sync: not synced, run External Package Sync: ' + rel)
+            continue
+        if any(matcher.exclude_dir(name) for name in parts[:-1]):
+            continue
+        if matcher.exclude_file(src) or not exists(src):
+            continue
+        if os.path.realpath(dest) == os.path.realpath(src):
+            # A package still linked into the repository
+            continue
+        if dry_run:
+            print('external_package_sync: copy: ' + src + ' -> ' + dest)
+            continue
+        if not isdir(dirname(dest)):
+            os.makedirs(dirname(dest))
+        copy_file(src, dest)
+        print('external_package_sync: copied ' + rel)
+
+
+class SyncQueue(object):
+    # Runs sync_files on a background thread for the paths added within
+    # DEBOUNCE seconds of each other, so saving several files at once
+    # causes one sync
+    DEBOUNCE = 0.3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.timer = None
+        # Called with the synced paths
+        self.on_synced = None
+
+    def add(self, rel):
+        with self.lock:
+            self.paths.add(rel)
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.DEBOUNCE, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            paths = sorted(self.paths)
+            self.paths = set()
+            self.timer = None
+        try:
+            sync_files(paths)
+            if self.on_synced:
+                self.on_synced(paths)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+
+sync_queue = SyncQueue()
 
 
 # def sync_file():
@@ -292,7 +1115,8 @@ try:
         return path_starts_with(abspath(path), sublime_packages_path())
 
     def is_under_repository(path):
-        return path_starts_with(path, repo_base)
+        # repo_base is None until the deferred init() has run
+        return repo_base is not None and path_starts_with(path, repo_base)
 
     def get_package_relative_path(path):
         try:
@@ -321,16 +1145,139 @@ try:
     #                 return pair
     #     return None
 
-    def reload_module(relfile):
-        for mod in sys.modules.values():
-            if mod and hasattr(mod, '__file__'):
-                path = mod.__file__
-                if path.endswith('.pyc'):
-                    path = path[:-1]
-                if path.endswith(relfile):
-                    print('external_package_sync: Reloading submodule: ' + mod.__file__)
-                    reload(mod)
-                    return
+    def reload_function():
+        try:
+            from importlib import reload
+        except ImportError:
+            try:
+                # Python 3.3 (Sublime Text 3)
+                from imp import reload
+            except ImportError:
+                # Python 2 builtin
+                reload = __builtins__['reload'] if isinstance(__builtins__, dict) else __builtins__.reload
+        return reload
+
+    def module_path(mod):
+        path = getattr(mod, '__file__', None)
+        if not path:
+            return None
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        return normcase(abspath(path))
+
+    class ModuleIndex(object):
+        # Modules by the path of their source, refreshed with the modules
+        # imported since the last lookup
+
+        def __init__(self):
+            self.names = set()
+            self.paths = {}
+            # (mtime, imported names) by path
+            self.import_cache = {}
+
+        def refresh(self):
+            for name in set(sys.modules) - self.names:
+                mod = sys.modules[name]
+                self.names.add(name)
+                path = module_path(mod) if mod else None
+                if path:
+                    self.paths[path] = name
+
+        def lookup(self, path):
+            self.refresh()
+            name = self.paths.get(normcase(abspath(path)))
+            return sys.modules.get(name) if name else None
+
+        def imports(self, mod):
+            # The names of the modules mod imports, read from its source and
+            # cached on its mtime
+            path = module_path(mod)
+            try:
+                mtime = os.stat(path).st_mtime
+            except (OSError, TypeError):
+                return set()
+            cached = self.import_cache.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+            import ast
+            with open(path, 'rb') as f:
+                tree = ast.parse(f.read(), path)
+            if hasattr(mod, '__path__'):
+                package = mod.__name__
+            else:
+                package = mod.__name__.rpartition('.')[0]
+            names = set()
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    names.update(alias.name for alias in node.names)
+                elif isinstance(node, ast.ImportFrom):
+                    base = node.module or ''
+                    if node.level:
+                        parts = package.split('.')
+                        parent = '.'.join(parts[:len(parts) - node.level + 1])
+                        base = parent + '.' + base if base else parent
+                    names.add(base)
+                    # "from package import submodule"
+                    names.update(base + '.' + alias.name for alias in node.names)
+            self.import_cache[path] = (mtime, names)
+            return names
+
+        def dependents(self, mod):
+            # The modules of the package of mod importing it, directly or
+            # not, each after the modules it depends on
+            top = mod.__name__.split('.')[0]
+            imports = {}
+            for name, other in list(sys.modules.items()):
+                if other and name != mod.__name__ and name.split('.')[0] == top:
+                    try:
+                        imports[name] = self.imports(other)
+                    except (IOError, SyntaxError, ValueError):
+                        continue
+
+            affected = set([mod.__name__])
+            changed = True
+            while changed:
+                changed = False
+                for name in imports:
+                    if name not in affected and imports[name] & affected:
+                        affected.add(name)
+                        changed = True
+
+            order = []
+            done = set([mod.__name__])
+            remaining = set(affected) - done
+            while remaining:
+                ready = sorted(name for name in remaining if not (imports[name] & remaining))
+                if not ready:
+                    # An import cycle, reload the rest in any order
+                    ready = sorted(remaining)
+                for name in ready:
+                    remaining.discard(name)
+                    done.add(name)
+                    order.append(sys.modules[name])
+            return order
+
+    module_index = ModuleIndex()
+
+    def reload_module(path):
+        # Reload the module loaded from path and the modules depending on it
+        mod = module_index.lookup(path)
+        if not mod:
+            return []
+        reload = reload_function()
+        modules = [mod] + module_index.dependents(mod)
+        for mod in modules:
+            print('external_package_sync: Reloading submodule: ' + mod.__file__)
+            reload(mod)
+        return modules
+
+    def reload_submodules(paths):
+        # paths are relative to repo_base, Package/plugin.py is a top level
+        # module, which Sublime Text reloads itself
+        for rel in paths:
+            if rel.endswith('.py') and rel.count(os.sep) >= 2:
+                reload_module(join(packages_path, rel))
 
     import sublime
     import sublime_plugin
@@ -340,7 +1287,14 @@ try:
         if not is_under_repository(repo_file):
             return False
         other = get_other_path(repo_file)
-        if exists(other) and not filecmp.cmp(repo_file, other):
+        if not exists(other):
+            return True
+        same = fingerprints.same(repo_file, other)
+        if same is None:
+            # Not hashed yet, on_load normally prefetches them
+            same = filecmp.cmp(repo_file, other, shallow=False)
+            fingerprints.prefetch([repo_file, other])
+        if not same:
             if not sublime.ok_cancel_dialog('external_package_sync: file content is not same. overwrite it?' + '\n' + repo_file + '\n' + other):
                 return False
         return True
@@ -349,6 +1303,11 @@ try:
         def on_load(self, view):
             if is_under_package(view.file_name()):
                 view.set_read_only(True)
+            elif view.file_name() and is_under_repository(view.file_name()):
+                # Hash both copies now, for can_sync in on_pre_save
+                other = get_other_path(view.file_name())
+                if other and exists(other):
+                    fingerprints.prefetch([view.file_name(), other])
 
         def on_pre_save(self, view):
             if view.file_name() and can_sync(view.file_name()):
@@ -357,9 +1316,10 @@ try:
         def on_post_save(self, view):
             if view.settings().get('external_package_sync_can_sync', False):
                 view.settings().erase('external_package_sync_can_sync')
-                sync_all_packages()
+                # Only the saved file, ExternalPackageSyncCommand mirrors the
+                # whole tree
+                sync_queue.add(get_package_relative_path(view.file_name()))
                 # self.extra_ops(view, fname, repo, package)
-                # self.reload_submodule(view, fname, repo, package)
 
         # def extra_ops(self, view, fname, repo, package):
         #     # FIXME Force reload sublime-project.
@@ -367,19 +1327,6 @@ try:
         #         for g in glob.glob(join(package, '**', basename(view.file_name()))):
         #             touch(g)
 
-        # def reload_submodule(self, fname, repo, package):
-        #     # FIXME
-        #     from os.path import relpath, dirname
-
-        #     try:
-        #         rel = relpath(fname, repo)
-        #     except ValueError:  # ValueError: path is on drive D:, start on drive C:
-        #         return
-        #     if dirname(rel) == '':
-        #         # top level modules will be reload automatically.
-        #         return
-        #     reload_module(rel)
-
     class ExternalPackageSyncCommand(sublime_plugin.ApplicationCommand):
         def run(self):
             sync_all_packages()
@@ -392,6 +1339,7 @@ try:
             #     subprocess.Popen([
             #         expandvars(r"$PROGRAMFILES\WinMerge\WinMergeU.exe"), '/r', pair[0], pair[1]])
             #     return
+            import subprocess
             package = get_package_name(self.view.file_name())
             if not package:
                 return
@@ -401,6 +1349,7 @@ try:
 
     class ExternalPackageEditCopyCommand(sublime_plugin.TextCommand):
         def run(self, edit):
+            import shutil
             src = self.view.file_name()
             dest = join(repo_base, 'User', basename(src))
             if src.endswith('.py'):
@@ -418,8 +1367,13 @@ try:
             for i in package_sync_status().items():
                 print(i)
 
+    # Reload the synced submodules on the main thread
+    sync_queue.on_synced = lambda paths: sublime.set_timeout(
+        lambda: reload_submodules(paths), 0)
+
     def plugin_loaded():
-        init()
+        # Off the startup path, set_timeout_async is missing in Sublime Text 2
+        getattr(sublime, 'set_timeout_async', sublime.set_timeout)(init, 0)
 
     if int(sublime.version()) < 3000:
         plugin_loaded()
@@ -428,72 +1382,6 @@ except ImportError:
     pass
 
 
-import unittest
-import tempfile
-from os.path import isdir
-from contextlib import contextmanager
-
-
-class Test(unittest.TestCase):
-    test_src = join(abspath(dirname(__file__)), 'Backup')
-    test_dest = join(tempfile.gettempdir(), 'Sublime Packages')
-
-    def setUp(self):
-        self.clean_dir(self.test_dest)
-        with pushd(self.test_dest):
-            self.make_pseudo_dest()
-
-        init(packages=self.test_dest)
-
-    @staticmethod
-    def clean_dir(dir_path):
-        if exists(dir_path):
-            for child in os.listdir(dir_path):
-                path = join(dir_path, child)
-                if isdir(path):
-                    shutil.rmtree(path)
-                else:
-                    os.remove(path)
-        else:
-            os.mkdir(dir_path)
-
-    def make_pseudo_dest(self):
-        os.mkdir('User')
-        os.mkdir('LiveDevelopment')
-        os.mkdir('Linter')
-        with open('User/Package Control.sublime-settings', 'w') as f:
-            f.write("""
-                {
-                    "installed_packages":
-                    [
-                        "LiveDevelopment",
-                        "Linter"
-                    ]
-                }
-                """)
-
-    def test_sync2(self):
-        test_excludes = ['LiveDevelopment']
-        execute_sync(self.test_src, self.test_dest, test_excludes)
-        for name in test_excludes:
-            self.assertTrue(exists(join(self.test_dest, name)))
-
-
-class TestSync(Test):
-    def test_xxx(self):
-        sync_all_packages()
-
-
-@contextmanager
-def pushd(to):
-    old_cwd = os.getcwd()
-    os.chdir(to)
-    try:
-        yield
-    finally:
-        os.chdir(old_cwd)
-
-
 def main():
     init()
     description()
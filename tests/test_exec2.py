@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+from os.path import abspath, dirname, join
+
+# exec2 runs outside of Sublime Text with the stub modules of the benchmarks
+root = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(root, 'bench'))
+sys.path.insert(1, root)
+
+import sublime
+from exec2 import (
+    StreamDecoder, OutputTransform, ResultIndex, FrameScanner, Scrollback,
+    FILTERS, expand_vars)
+
+
+class TestStreamDecoder(unittest.TestCase):
+    def test_split_multibyte(self):
+        decoder = StreamDecoder('utf-8')
+        data = u'caf\xe9 ✓\n'.encode('utf-8')
+        text = ''.join(decoder.decode(data[i:i + 1]) for i in range(len(data)))
+        self.assertEqual(text + decoder.decode(b'', True), u'caf\xe9 ✓\n')
+
+    def test_split_crlf(self):
+        decoder = StreamDecoder('utf-8')
+        self.assertEqual(decoder.decode(b'a\r'), 'a')
+        self.assertEqual(decoder.decode(b'\nb\r'), '\nb')
+        self.assertEqual(decoder.decode(b'c'), '\nc')
+        self.assertEqual(decoder.decode(b'\r', True), '\n')
+
+    def test_keep_cr(self):
+        decoder = StreamDecoder('utf-8', translate_cr=False)
+        self.assertEqual(decoder.decode(b'10%\r'), '10%')
+        self.assertEqual(decoder.decode(b'20%\r\n'), '\r20%\n')
+
+    def test_decode_error(self):
+        decoder = StreamDecoder('utf-8')
+        text = decoder.decode(b'a\xffb\n') + decoder.decode(b'\xfe\n')
+        self.assertEqual(text.count('[Decode error'), 1)
+        self.assertTrue(text.endswith(u'a�b\n�\n'))
+
+
+class TestOutputTransform(unittest.TestCase):
+    def transform(self, **options):
+        filters = dict(FILTERS)
+        filters.update(options)
+        return OutputTransform(filters)
+
+    def test_progress_collapsed(self):
+        transform = self.transform()
+        out = transform.feed('start\n10%\r')
+        out += transform.feed('20%\r30')
+        self.assertEqual(transform.progress(), '30%')
+        out += transform.feed('%\rdone\n')
+        self.assertEqual(transform.progress(), None)
+        self.assertEqual(out + transform.finish(), 'start\ndone\n')
+
+    def test_progress_shorter_line(self):
+        transform = self.transform()
+        out = transform.feed('downloading\rok\n')
+        self.assertEqual(out, 'okwnloading\n')
+
+    def test_ansi_split(self):
+        transform = self.transform()
+        out = transform.feed('\x1b[3')
+        self.assertEqual(out, '')
+        out += transform.feed('1mred\x1b[0')
+        out += transform.feed('m plain\n')
+        self.assertEqual(out, 'red plain\n')
+
+    def test_partial_line_shown(self):
+        transform = self.transform()
+        self.assertEqual(transform.feed('Running'), 'Running')
+        self.assertEqual(transform.feed(' tests\n'), ' tests\n')
+
+    def test_collapse_repeats(self):
+        transform = self.transform(collapse_repeats=True)
+        out = transform.feed('a\na\na\nb\n') + transform.finish()
+        self.assertEqual(out, 'a\n[previous line repeated 2 more times]\nb\n')
+
+    def test_drop_and_keep(self):
+        transform = self.transform(keep=['error'], drop=['ignored'])
+        out = transform.feed('ok\nerror: x\nerror: ignored\n') + transform.finish()
+        self.assertEqual(out, 'error: x\n')
+
+
+class TestResultIndex(unittest.TestCase):
+    def test_partial_lines(self):
+        index = ResultIndex(r'^(.+):(\d+):(\d+): (.*)$', None, '/src')
+        index.feed('main.c:3:1')
+        index.feed('4: error: x\nmain')
+        self.assertEqual(index.results, [('/src/main.c', 3, 14, 'error: x')])
+        index.feed('.c:5:1: warning')
+        index.finish()
+        self.assertEqual(index.results[1], ('/src/main.c', 5, 1, 'warning'))
+
+    def test_line_regex(self):
+        index = ResultIndex(r'^File "(.+)"$', r'^  line (\d+)$', '/src')
+        index.feed('File "/abs/a.py"\n  line 2\n  line 7\n')
+        self.assertEqual(index.results, [('/abs/a.py', 2, 0, ''), ('/abs/a.py', 7, 0, '')])
+
+
+class TestFrameScanner(unittest.TestCase):
+    def test_marker_in_one_read(self):
+        scanner = FrameScanner('tok')
+        self.assertEqual(scanner.feed(b'out\n\x1ftok 0\n'), (b'out\n', b'0'))
+
+    def test_split_marker(self):
+        scanner = FrameScanner('tok')
+        self.assertEqual(scanner.feed(b'out\x1ft'), (b'out', None))
+        self.assertEqual(scanner.feed(b'ok 1'), (b'', None))
+        self.assertEqual(scanner.feed(b'2\n'), (b'', b'12'))
+
+    def test_not_a_marker(self):
+        scanner = FrameScanner('tok')
+        self.assertEqual(scanner.feed(b'a\x1ft'), (b'a', None))
+        self.assertEqual(scanner.feed(b'ea\n'), (b'\x1ftea\n', None))
+
+
+class TestExpandVars(unittest.TestCase):
+    def test_expand(self):
+        environ = {'HOME': '/home/me', 'NAME': 'x'}
+        self.assertEqual(expand_vars('$HOME/${NAME}.log', environ), '/home/me/x.log')
+        self.assertEqual(expand_vars('$MISSING/a', environ), '$MISSING/a')
+        self.assertEqual(expand_vars('plain', environ), 'plain')
+
+
+class TestScrollback(unittest.TestCase):
+    def append(self, view, scrollback, text):
+        view.run_command('append', {'characters': text})
+        scrollback.append(text)
+
+    def test_trim_lines(self):
+        view = sublime.View()
+        scrollback = Scrollback(view, max_lines=4)
+        try:
+            for i in range(10):
+                self.append(view, scrollback, 'line %d\n' % i)
+            lines = view.text().splitlines()
+            # Trimmed back to max_lines once they're exceeded by a quarter
+            self.assertTrue(lines[0].startswith('[6 lines omitted, full output in '))
+            self.assertEqual(lines[1:], ['line %d' % i for i in range(6, 10)])
+
+            scrollback.flush()
+            with open(scrollback.path) as f:
+                self.assertEqual(f.read(), ''.join('line %d\n' % i for i in range(10)))
+        finally:
+            scrollback.discard()
+        self.assertFalse(os.path.exists(scrollback.path))
+
+    def test_no_limit(self):
+        view = sublime.View()
+        scrollback = Scrollback(view)
+        for i in range(100):
+            self.append(view, scrollback, 'line\n')
+        self.assertEqual(scrollback.spill, None)
+        self.assertEqual(view.text().count('\n'), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+from os.path import join, exists, isdir, abspath, dirname, basename
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import external_package_sync
+from external_package_sync import (
+    init, execute_sync, sync_files, package_sync_status, copy_file, sync_all_packages, mirror, create_plan,
+    SyncPlan, journal_path, ExcludeMatcher, fingerprints, file_digest,
+    reload_module, reload_submodules, load_cached, list_dir, USERVARS, MMAP_THRESHOLD, BLOCK_SIZE)
+
+
+class Test(unittest.TestCase):
+    test_src = join(tempfile.gettempdir(), 'Sublime Packages Repository')
+    test_dest = join(tempfile.gettempdir(), 'Sublime Packages')
+
+    def setUp(self):
+        self.clean_dir(self.test_src)
+        with pushd(self.test_src):
+            self.make_pseudo_src()
+        self.clean_dir(self.test_dest)
+        with pushd(self.test_dest):
+            self.make_pseudo_dest()
+
+        # Keep the manifests and journals of each test apart, and out of
+        # the cache directory of a real installation
+        self.cache_dir = tempfile.mkdtemp()
+        self.manifest_path = external_package_sync.manifest_path
+        external_package_sync.manifest_path = lambda root: join(
+            self.cache_dir, basename(self.manifest_path(root)))
+        external_package_sync.manifests.clear()
+        external_package_sync.mtime_cache.clear()
+
+        self.globals = (external_package_sync.repo_base, external_package_sync.packages_path)
+        init(packages=self.test_dest)
+
+    def tearDown(self):
+        external_package_sync.repo_base, external_package_sync.packages_path = self.globals
+        external_package_sync.manifest_path = self.manifest_path
+        external_package_sync.manifests.clear()
+        shutil.rmtree(self.cache_dir)
+
+    @staticmethod
+    def clean_dir(dir_path):
+        if exists(dir_path):
+            for child in os.listdir(dir_path):
+                path = join(dir_path, child)
+                if isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        else:
+            os.mkdir(dir_path)
+
+    def make_pseudo_dest(self):
+        os.mkdir('User')
+        os.mkdir('LiveDevelopment')
+        os.mkdir('Linter')
+        with open('User/Package Control.sublime-settings', 'w') as f:
+            f.write("""
+                {
+                    "installed_packages":
+                    [
+                        "LiveDevelopment",
+                        "Linter"
+                    ]
+                }
+                """)
+
+    def make_pseudo_src(self):
+        os.makedirs('User/.git')
+        os.mkdir('MyPackage')
+        for name in ['User/Preferences.sublime-settings', 'User/.git/HEAD',
+                     'MyPackage/plugin.py', 'MyPackage/plugin.pyc']:
+            with open(name, 'w') as f:
+                f.write(name)
+
+    def test_sync2(self):
+        test_excludes = ['LiveDevelopment']
+        execute_sync(self.test_src, self.test_dest, test_excludes)
+        for name in test_excludes:
+            self.assertTrue(exists(join(self.test_dest, name)))
+        self.assertTrue(exists(join(self.test_dest, 'MyPackage', 'plugin.py')))
+        self.assertFalse(exists(join(self.test_dest, 'MyPackage', 'plugin.pyc')))
+        self.assertFalse(exists(join(self.test_dest, 'User', '.git')))
+        # Package Control.sublime-settings is excluded from the purge
+        self.assertTrue(exists(join(self.test_dest, 'User', 'Package Control.sublime-settings')))
+
+    def test_sync_files(self):
+        external_package_sync.repo_base = self.test_src
+        execute_sync(self.test_src, self.test_dest, ['LiveDevelopment'])
+        path = join('MyPackage', 'plugin.py')
+        with open(join(self.test_src, path), 'w') as f:
+            f.write('changed')
+        sync_files([path, join('User', '.git', 'HEAD')])
+        with open(join(self.test_dest, path)) as f:
+            self.assertEqual(f.read(), 'changed')
+        self.assertFalse(exists(join(self.test_dest, 'User', '.git')))
+
+    def test_package_sync_status_keeps_config(self):
+        external_package_sync.repo_base = self.test_src
+        exclude = external_package_sync.config['additional_exclude_packages']
+        before = dict((key, list(value)) for key, value in exclude.items())
+        package_sync_status()
+        package_sync_status()
+        self.assertEqual(exclude, before)
+
+    def test_copy_file_concurrently(self):
+        src = join(self.test_src, 'MyPackage', 'plugin.py')
+        dest = join(self.test_dest, 'plugin.py')
+        errors = []
+
+        def copy():
+            try:
+                for i in range(50):
+                    copy_file(src, dest)
+            except (IOError, OSError) as e:
+                errors.append(e)
+        threads = [threading.Thread(target=copy) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(file_digest(src), file_digest(dest))
+        self.assertEqual(os.listdir(self.test_dest).count('plugin.py'), 1)
+        self.assertFalse([name for name in os.listdir(self.test_dest) if name.endswith('.sync-tmp')])
+
+    def test_load_cached_racy(self):
+        # A package added within the same mtime tick as the listing
+        mtime = os.stat(self.test_dest).st_mtime
+        self.assertEqual(sorted(load_cached(self.test_dest, list_dir)),
+                         ['Linter', 'LiveDevelopment', 'User'])
+        os.mkdir(join(self.test_dest, 'MyPackage'))
+        os.utime(self.test_dest, (mtime, mtime))
+        self.assertIn('MyPackage', load_cached(self.test_dest, list_dir))
+
+    def test_fingerprints(self):
+        execute_sync(self.test_src, self.test_dest, ['LiveDevelopment'])
+        src = join(self.test_src, 'MyPackage', 'plugin.py')
+        dest = join(self.test_dest, 'MyPackage', 'plugin.py')
+        if os.name != 'nt':
+            # Filled by copy_file
+            self.assertTrue(fingerprints.same(src, dest))
+        with open(src, 'w') as f:
+            f.write('MyPackage/plugin.pX')
+        self.assertEqual(fingerprints.same(src, dest), None)
+        self.assertNotEqual(fingerprints.digest(src), fingerprints.digest(dest))
+
+    def test_exclude_matcher(self):
+        matcher = ExcludeMatcher([join(self.test_dest, 'LiveDevelopment')])
+        self.assertTrue(matcher.exclude_dir(join(self.test_src, 'User', '.git')))
+        self.assertTrue(matcher.exclude_dir(join(self.test_src, '__pycache__')))
+        self.assertTrue(matcher.exclude_dir(join(self.test_dest, 'LiveDevelopment')))
+        self.assertFalse(matcher.exclude_dir(join(self.test_src, 'LiveDevelopment')))
+        self.assertTrue(matcher.exclude_file('plugin.pyc'))
+        self.assertTrue(matcher.exclude_file(join('User', 'MediaPlayer 01.txt')))
+        self.assertTrue(matcher.exclude_file(USERVARS))
+        self.assertFalse(matcher.exclude_file('plugin.py'))
+        self.assertFalse(matcher.exclude_file('Preferences.sublime-settings'))
+
+    def test_patch_large_file(self):
+        src = join(self.test_src, 'MyPackage', 'font.ttf')
+        dest = join(self.test_dest, 'MyPackage', 'font.ttf')
+        with open(src, 'wb') as f:
+            f.write(b'x' * (MMAP_THRESHOLD + BLOCK_SIZE // 2))
+        mirror(self.test_src, self.test_dest)
+        inode = os.stat(dest).st_ino
+        with open(src, 'r+b') as f:
+            f.seek(BLOCK_SIZE + 10)
+            f.write(b'changed')
+        self.assertNotEqual(fingerprints.digest(src), fingerprints.digest(dest))
+        mirror(self.test_src, self.test_dest)
+        self.assertEqual(os.stat(dest).st_ino, inode)
+        self.assertEqual(file_digest(src), file_digest(dest))
+        self.assertEqual(fingerprints.digest(src), fingerprints.digest(dest))
+
+    def test_large_library_replaced(self):
+        src = join(self.test_src, 'MyPackage', 'runtime.so')
+        dest = join(self.test_dest, 'MyPackage', 'runtime.so')
+        with open(src, 'wb') as f:
+            f.write(b'x' * MMAP_THRESHOLD)
+        mirror(self.test_src, self.test_dest)
+        inode = os.stat(dest).st_ino
+        with open(src, 'r+b') as f:
+            f.write(b'changed')
+        mirror(self.test_src, self.test_dest)
+        self.assertNotEqual(os.stat(dest).st_ino, inode)
+        self.assertEqual(file_digest(src), file_digest(dest))
+
+    def test_resume_plan(self):
+        plan = create_plan(self.test_src, self.test_dest, ['LiveDevelopment'])
+        self.assertEqual(SyncPlan.from_dict(plan.to_dict()).to_json(), plan.to_json())
+        copied = []
+        original = external_package_sync.copy_file
+
+        def interrupted(src, dest):
+            if copied:
+                raise IOError('interrupted')
+            copied.append(src)
+            original(src, dest)
+        external_package_sync.copy_file = interrupted
+        try:
+            self.assertRaises(IOError, plan.apply, 1)
+        finally:
+            external_package_sync.copy_file = original
+        self.assertTrue(exists(journal_path(self.test_dest)))
+
+        resumed = SyncPlan.resume(self.test_dest)
+        self.assertEqual(len(resumed.copies()), len(plan.copies()))
+        self.assertFalse(exists(journal_path(self.test_dest)))
+        self.assertTrue(create_plan(self.test_src, self.test_dest, ['LiveDevelopment']).empty())
+
+    def interrupted_plan(self):
+        plan = create_plan(self.test_src, self.test_dest, ['LiveDevelopment'])
+        original = external_package_sync.copy_file
+
+        def interrupted(src, dest):
+            raise IOError('interrupted')
+        external_package_sync.copy_file = interrupted
+        try:
+            self.assertRaises(IOError, plan.apply, 1)
+        finally:
+            external_package_sync.copy_file = original
+        self.assertTrue(exists(journal_path(self.test_dest)))
+        return plan
+
+    def test_resume_removed_source(self):
+        self.interrupted_plan()
+        os.remove(join(self.test_src, 'MyPackage', 'plugin.py'))
+        plan = create_plan(self.test_src, self.test_dest, ['LiveDevelopment'])
+        self.assertFalse(exists(journal_path(self.test_dest)))
+        self.assertTrue(plan.empty())
+        self.assertFalse(exists(join(self.test_dest, 'MyPackage', 'plugin.py')))
+
+    def test_resume_failure_discards_journal(self):
+        self.interrupted_plan()
+        original = external_package_sync.copy_file
+
+        def failing(src, dest):
+            raise OSError('failing')
+        external_package_sync.copy_file = failing
+        try:
+            self.assertEqual(SyncPlan.resume(self.test_dest), None)
+        finally:
+            external_package_sync.copy_file = original
+        self.assertFalse(exists(journal_path(self.test_dest)))
+        mirror(self.test_src, self.test_dest, ['LiveDevelopment'])
+        self.assertTrue(exists(join(self.test_dest, 'MyPackage', 'plugin.py')))
+
+    def test_reload_module(self):
+        package = join(self.test_src, 'reload_test')
+        os.mkdir(package)
+        for name, text in [('__init__.py', ''),
+                           ('base.py', 'VALUE = 1\n'),
+                           ('user.py', 'from .base import VALUE\n'),
+                           ('other.py', 'from . import user\n')]:
+            with open(join(package, name), 'w') as f:
+                f.write(text)
+        sys.path.insert(0, self.test_src)
+        try:
+            import reload_test.other
+            with open(join(package, 'base.py'), 'w') as f:
+                f.write('VALUE = 2  # changed\n')
+            modules = reload_module(join(package, 'base.py'))
+            self.assertEqual([m.__name__ for m in modules],
+                             ['reload_test.base', 'reload_test.user', 'reload_test.other'])
+            self.assertEqual(sys.modules['reload_test.user'].VALUE, 2)
+        finally:
+            sys.path.remove(self.test_src)
+            for name in list(sys.modules):
+                if name.startswith('reload_test'):
+                    del sys.modules[name]
+
+    def test_reload_submodules(self):
+        # Each module counts how many times its body ran
+        package = join(self.test_dest, 'reload_pkg')
+        os.makedirs(join(package, 'lib'))
+        for name in ['__init__.py', 'plugin.py', join('lib', '__init__.py'), join('lib', 'helper.py')]:
+            with open(join(package, name), 'w') as f:
+                f.write("LOADS = globals().get('LOADS', 0) + 1\n")
+        sys.path.insert(0, self.test_dest)
+        try:
+            import reload_pkg.plugin
+            import reload_pkg.lib.helper
+            reload_submodules([join('reload_pkg', 'plugin.py'),
+                               join('reload_pkg', 'lib', 'helper.py')])
+            self.assertEqual(sys.modules['reload_pkg.plugin'].LOADS, 1)
+            self.assertEqual(sys.modules['reload_pkg.lib.helper'].LOADS, 2)
+        finally:
+            sys.path.remove(self.test_dest)
+            for name in list(sys.modules):
+                if name.startswith('reload_pkg'):
+                    del sys.modules[name]
+
+    def test_mirror_incremental(self):
+        mirror(self.test_src, self.test_dest, ['LiveDevelopment'])
+        os.remove(join(self.test_src, 'MyPackage', 'plugin.py'))
+        with open(join(self.test_src, 'User', 'Preferences.sublime-settings'), 'a') as f:
+            f.write('changed')
+        plan = mirror(self.test_src, self.test_dest, ['LiveDevelopment'])
+        self.assertEqual(plan.mkdirs, [])
+        self.assertEqual(plan.adds, [])
+        self.assertEqual([basename(s) for s, d, size in plan.updates], ['Preferences.sublime-settings'])
+        self.assertEqual(plan.removes, [join(self.test_dest, 'MyPackage', 'plugin.py')])
+        # Linter is not in the repository
+        self.assertFalse(exists(join(self.test_dest, 'Linter')))
+
+
+class TestSync(Test):
+    def setUp(self):
+        Test.setUp(self)
+        if not exists(external_package_sync.repo_base):
+            self.tearDown()
+            self.skipTest('needs the Dropbox repository')
+
+    def test_xxx(self):
+        sync_all_packages()
+
+
+@contextmanager
+def pushd(to):
+    old_cwd = os.getcwd()
+    os.chdir(to)
+    try:
+        yield
+    finally:
+        os.chdir(old_cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()